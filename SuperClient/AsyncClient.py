@@ -0,0 +1,284 @@
+'''
+	SuperClient/AsyncClient.py
+	The asyncio version of the Client. The pipeline is the same, only the
+	active methods are coroutines that use the connection classes from
+	AsyncCommunication.py. Run it with:
+
+		asyncio.run(AsyncClient().start(sys.argv))
+'''
+
+import asyncio
+import time
+
+from SuperClient.AsyncCommunication import *
+import SuperClient.Client
+from SuperClient.Client import Client
+from SuperClient.Log import Log
+
+
+class AsyncClient(Client):
+
+	async def start(self, args):
+		'''
+		Start the client with required arguments <address> and <port>.
+		See Client.start() for details.
+		'''
+
+		# validate arguments and set options accordingly
+		if not self.validateArgs(args):
+			return
+
+		started = time.monotonic()
+
+		# from here on the output may be written in the background, so
+		# every exit goes through the finally block that flushes it
+		try:
+			# construct the log class for detailed logging
+			if not self.openTrace():
+				return
+
+			self.log = Log(self.ui, self.verbose, self.tracer)
+			self.startMetrics()
+
+			if not self.startProfile():
+				return
+
+			# Welcome!
+			self.splash()
+
+			self.ui.info("Fetching connection parameters...")
+
+			# fetch parameters from the server using TCP
+			if not await self.fetchCommParams():
+				return
+
+			self.ui.event('handshake', cid=self.cid, udp_port=self.srv_udp_port, encryption=self.opt_enc, multipart=self.opt_mul, parity=self.opt_par)
+			self.profilePhase('params')
+
+			self.ui.info("Opening UDP connection...")
+
+			# jump to the "main" loop!
+			if not await self.UDPLoop():
+				return
+
+			self.ui.info("Exchange over, quitting...\n")
+
+			# successfully went through the pipeline!
+			self.shutdown()
+
+		finally:
+			self.endSession(time.monotonic() - started)
+			self.stopProfile()
+			self.closeTrace()
+			self.closeMetrics()
+			self.closeOutput()
+
+
+	#--------------------------------------------------
+	# 				ACTIVE METHODS
+	#--------------------------------------------------
+	# Same rules as in Client, but these are coroutines.
+	# -------------------------------------------------
+
+	async def UDPLoop(self):
+		'''
+		See Client.UDPLoop().
+		'''
+		self.udp = AsyncUDPConnection(self.cid, self.srv_address, self.srv_udp_port, self.log)
+		await self.udp.connect()
+
+		# enable UDP extra features
+		self.setupUDP()
+
+		# send initial UDP message
+		await self.udp.send(('HELLO from ' + self.cid).encode(ENCODING))
+
+		# show some progress
+		self.ui.info_ok("Success")
+		self.ui.info("Waiting for challenges...")
+
+		# the first response is to the HELLO
+		round_trip = self.m_hello
+		challenges = 0
+
+		while True:
+
+			# receive a message, give up if the server stops responding
+			try:
+				message, eom = await self.udp.receive()
+			except RetransmissionError:
+				self.udp.close()
+				self.closeControl()
+				return self.setError(self.ERR_UDP_RESPONSE)
+
+			round_trip.record(time.monotonic() - self.udp.sent_at)
+			round_trip = self.m_round_trip
+			challenges += 1
+
+			# profile snapshot every now and then
+			if challenges % self.profile_every == 0 and not eom:
+				self.profilePhase('challenge-{}'.format(challenges))
+
+			# the messages are bytes until here
+			challenge = message.decode(ENCODING, 'replace')
+			solution = self.answerChallenge(challenge, eom)
+
+			# End Of Messaging --> break the loop
+			if eom: break
+
+			data = solution.encode(ENCODING)
+
+			# fetch new keys before they run out
+			await self.checkKeys(data)
+
+			# send the solution back to the server (word reversed)
+			await self.udp.send(data)
+
+		# Success! Close the connection and leave.
+		self.udp.close()
+		self.closeControl()
+		return True
+
+
+	async def fetchCommParams(self):
+		'''
+		See Client.fetchCommParams().
+		'''
+
+		# 1. Setup Connection
+
+		request = self.buildRequest()
+		fresh = False
+
+		while True:
+			if not await self.openTCP(fresh):
+				return False
+
+			# 2. Fetch the Parameters
+
+			started = time.monotonic()
+
+			try:
+				response = await self.requestCommParams(request)
+			except OSError:
+				response = []
+
+			self.m_params.record(time.monotonic() - started)
+
+			# a pooled connection was closed by the server, try a new one
+			if self.tcp.reused and not self.responseComplete(response):
+				self.tcp.close()
+				fresh = True
+				continue
+
+			break
+
+		# 3. Handle the Response
+
+		if not self.applyCommParams(response):
+			self.closeTCP(False)
+			return False
+
+		# we are done here, close the connection (or keep it for the next session)
+		# unless it's needed for rekeying later
+		if not (self.rekey and self.opt_enc):
+			self.closeTCP(True)
+
+		return True
+
+	async def openTCP(self, fresh=False):
+		'''
+		See Client.openTCP(). @self.tcp_pool must be an AsyncTCPPool.
+		'''
+		try:
+			if self.tcp_pool is not None:
+				self.tcp = await self.tcp_pool.acquire(self.srv_address, self.srv_tcp_port, self.log, fresh)
+			else:
+				self.tcp = AsyncTCPConnection(self.srv_address, self.srv_tcp_port, self.log)
+				await self.tcp.connectToServer()
+
+		except ConnectionRefusedError:
+			return self.setError(self.ERR_TCP_CONN)
+
+		return True
+
+	async def requestCommParams(self, request):
+		'''
+		See Client.requestCommParams().
+		'''
+		await self.tcp.send(request + [''] if self.tcp_pool is not None else request)
+
+		response = []
+
+		async for message in self.tcp.messages(0.0 if self.opt_enc else TCP_TAIL_GRACE):
+			response.append(message)
+
+			if self.responseComplete(response): break
+
+		return response
+
+
+	#--------------------------------------------------
+	# 				   REKEYING
+	#--------------------------------------------------
+	# See Client, the keys are fetched in a task instead
+	# of a thread.
+	# -------------------------------------------------
+
+	async def checkKeys(self, message):
+		'''
+		See Client.checkKeys().
+		'''
+		if not (self.rekey and self.opt_enc) or self.rekey_stopped: return
+
+		if self.rekeyDue(message):
+			await asyncio.wait([self.rekey_job], timeout=SuperClient.Client.REKEY_TIMEOUT)
+
+			if self.rekey_keys is None:
+				self.stopRekey()
+				return
+
+		self.updateKeys()
+		return
+
+	def startRekey(self, keys_en):
+		'''
+		Fetch new keys in a background task.
+		'''
+		self.rekey_job = asyncio.ensure_future(self.fetchKeys(keys_en))
+		return
+
+	async def fetchKeys(self, keys_en):
+		'''
+		See Client.fetchKeys().
+		'''
+		keys_de = None
+
+		try:
+			await self.tcp.send(self.buildRekey(keys_en))
+
+			response = []
+			async for message in self.tcp.messages(timeout=SuperClient.Client.REKEY_TIMEOUT):
+				response.append(message)
+				if self.rekeyComplete(response): break
+
+			keys_de = self.parseRekey(response)
+
+		except (OSError, asyncio.TimeoutError):
+			pass
+
+		self.rekey_keys = (keys_en, keys_de)
+
+	def closeControl(self):
+		'''
+		See Client.closeControl().
+		'''
+		if not (self.rekey and self.opt_enc) or self.tcp is None: return
+
+		if self.rekey_stopped or (self.rekey_job is not None and self.rekey_keys is None):
+			if self.rekey_job is not None: self.rekey_job.cancel()
+			self.closeTCP(False)
+		else:
+			self.closeTCP(True)
+
+		return
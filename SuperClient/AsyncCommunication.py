@@ -0,0 +1,269 @@
+'''
+	SuperClient/AsyncCommunication.py
+	This file contains asyncio versions of the connection classes. They work
+	exactly like the ones in Communication.py (same options, same messages)
+	but send() and receive() are coroutines, so a single process can run lots
+	of sessions at the same time without a thread per session.
+'''
+
+import asyncio
+import time
+
+from SuperClient.Communication import *
+
+
+class AsyncTCPConnection:
+	'''
+	Same as TCPConnection but uses asyncio streams.
+	'''
+	addr = ''
+	port = 0
+	reader = None
+	writer = None
+	lines = None 		# LineReader, splits the stream into messages
+	reused = False 		# taken from a TCPPool, used before
+	log = None
+
+	# metrics, see TCPConnection
+	m_opened = TCPConnection.m_opened
+	m_connect = TCPConnection.m_connect
+	m_bytes_sent = TCPConnection.m_bytes_sent
+	m_bytes_received = TCPConnection.m_bytes_received
+
+	def __init__(self, addr, port, log):
+		'''
+		Constructs an instance of the class. The connection is
+		opened in connectToServer().
+		'''
+		self.addr = addr
+		self.port = port
+		self.log = log
+		self.lines = LineReader(MSG_DELIMETER, ENCODING)
+
+		return
+
+	async def connectToServer(self):
+		'''
+		Simply connects to the configured server.
+		'''
+		started = time.monotonic()
+		self.reader, self.writer = await asyncio.open_connection(self.addr, self.port)
+
+		self.m_connect.record(time.monotonic() - started)
+		self.m_opened.inc()
+
+		return
+
+	async def send(self, messages):
+		'''
+		@messages is a list of strings to be sent.
+		'''
+		request = MSG_DELIMETER.join(messages).encode(ENCODING)
+
+		self.writer.write(request)
+		self.m_bytes_sent.inc(len(request))
+		await self.writer.drain()
+
+	async def messages(self, grace=0.0, timeout=None):
+		'''
+		See TCPConnection.messages(). This is an async generator, raises
+		asyncio.TimeoutError on @timeout.
+		'''
+		while True:
+			for message in self.lines.messages():
+				yield message
+
+			tail = self.lines.tail()
+
+			if tail == MSG_END:
+				yield self.lines.flush()
+				continue
+
+			try:
+				response = await asyncio.wait_for(self.reader.read(RECV_BYTES), grace if grace and tail else timeout)
+			except asyncio.TimeoutError:
+				if not (grace and tail): raise
+				yield self.lines.flush()
+				continue
+
+			# connection closed, whatever is left is the last message
+			if not response:
+				if tail: yield self.lines.flush()
+				return
+
+			self.m_bytes_received.inc(len(response))
+			self.log.received_tcp(self.lines.feed(response))
+
+	def healthy(self):
+		'''
+		See TCPConnection.healthy().
+		'''
+		return not (self.writer.is_closing() or self.reader.at_eof())
+
+	def close(self):
+		'''
+		Simply close the connection.
+		'''
+		self.writer.close()
+		return
+
+
+class AsyncTCPPool(TCPPool):
+	'''
+	Same as TCPPool but for AsyncTCPConnections. Opening connections
+	are coroutines, the rest works the same.
+	'''
+
+	async def acquire(self, addr, port, log, fresh=False):
+		'''
+		See TCPPool.acquire().
+		'''
+		tcp = None if fresh else self.reuse(addr, port, log)
+
+		if tcp is None:
+			tcp = AsyncTCPConnection(addr, port, log)
+			await tcp.connectToServer()
+			self.misses += 1
+
+		return tcp
+
+	async def warm(self, addr, port, log, count=None):
+		'''
+		See TCPPool.warm(). The connections are opened concurrently.
+		'''
+		idle = self.idle.setdefault((addr, port), [])
+		count = self.size if count is None else min(count, self.size)
+		conns = [AsyncTCPConnection(addr, port, log) for k in range(count - len(idle))]
+
+		await asyncio.gather(*[tcp.connectToServer() for tcp in conns])
+
+		idle += [(tcp, time.monotonic()) for tcp in conns]
+		return
+
+
+class DatagramQueue(asyncio.DatagramProtocol):
+	'''
+	Puts received datagrams in a queue, from which AsyncUDPConnection.receive()
+	picks them up.
+	'''
+	queue = None
+
+	def __init__(self):
+		self.queue = asyncio.Queue()
+
+	def datagram_received(self, data, addr):
+		self.queue.put_nowait(data)
+
+	def error_received(self, exc):
+		# e.g. ICMP port unreachable, nothing to do but wait for the timeout
+		pass
+
+
+class AsyncUDPConnection(UDPConnection):
+	'''
+	Same as UDPConnection but uses an asyncio datagram endpoint. All the work
+	(encryption, multipart, parity, retransmissions) is done by the protocol
+	methods of UDPConnection, only the I/O is different.
+	'''
+	transport = None
+	protocol = None
+
+	def createSocket(self):
+		'''
+		No socket is needed, the endpoint is created in connect().
+		'''
+		return None
+
+	def createPool(self):
+		'''
+		No buffers are needed, the datagrams arrive in the queue.
+		'''
+		return None
+
+	async def connect(self):
+		'''
+		Create the datagram endpoint. Must be called before sending.
+		'''
+		loop = asyncio.get_running_loop()
+		self.transport, self.protocol = await loop.create_datagram_endpoint(
+			DatagramQueue,
+			remote_addr=(self.addr, self.port)
+		)
+		return
+
+	async def send(self, message, ack=True):
+		'''
+		See UDPConnection.send(). The transport copies the datagram
+		if it can't be sent right away, so the shared buffer is safe.
+		'''
+		if ack: self.tx_message = message
+
+		if ack and self.opt_sync:
+			self.tx_last = [bytes(datagram) for datagram in self.datagrams(message)]
+			await self.resend()
+			return
+
+		for datagram in self.datagrams(message, ack):
+			self.transport.sendto(datagram)
+
+		return
+
+	async def resend(self):
+		'''
+		See UDPConnection.resend().
+		'''
+		if not self.opt_sync:
+			await self.send(self.tx_message)
+			return
+
+		for datagram in self.tx_last:
+			self.transport.sendto(datagram)
+
+		return
+
+	async def receive(self):
+		'''
+		See UDPConnection.receive().
+		'''
+		self.beginReceive()
+		status = self.RX_WAIT
+
+		while True:
+
+			if status == self.RX_HOLD:
+				timeout = self.holdTime()
+			else:
+				timeout = self.rtt.timeout() if self.opt_tmo else None
+
+			try:
+				packet = await asyncio.wait_for(self.protocol.queue.get(), timeout)
+			except asyncio.TimeoutError:
+				if status == self.RX_HOLD:
+					# nothing was left behind --> take the message
+					status = self.acceptMessage()
+				else:
+					# nothing arrived in time --> ask again
+					self.handleTimeout()
+					await self.send(RETRANSMIT_BYTES, ack=False)
+					continue
+			else:
+				status = self.handleDatagram(packet)
+
+			if status == self.RX_RETRY:
+				await self.send(RETRANSMIT_BYTES, ack=False)
+
+			elif status == self.RX_RESEND:
+				await self.resend()
+
+			elif status == self.RX_DONE:
+				break
+
+		return (self.rx_message, self.rx_eom)
+
+	def close(self):
+		'''
+		Simply close the transport.
+		'''
+		if self.transport is not None:
+			self.transport.close()
+		return
@@ -0,0 +1,391 @@
+'''
+	SuperClient/Benchmark.py
+	Benchmarks for the hot paths of the client: packing, encryption, parity,
+	partitioning, the challenge solver and the UI (micro benchmarks), and whole
+	sessions against a local reference server (macro benchmarks).
+
+	Results are written as JSON so that runs can be compared, and a run can
+	be compared against an earlier one (the baseline) to catch regressions.
+'''
+
+import asyncio
+import json
+import os
+import platform
+import statistics
+import time
+
+from SuperClient.Client import Client
+from SuperClient.Communication import *
+from SuperClient.LoadGen import LoadSession, PHASES
+from SuperClient.Log import Log
+from SuperClient.Metrics import Histogram
+from SuperClient.Server import ReferenceServer
+from SuperClient.Trace import Tracer
+from SuperClient.UI import UI, SilentUI
+from SuperClient.utils import parse_flags
+
+BENCH_REPEAT = 5 						# timed runs per benchmark, the best one counts
+BENCH_MIN_TIME = 0.2 					# a timed run lasts at least this long (s)
+BENCH_SESSIONS = 20 					# sessions per run of a macro benchmark
+BENCH_CONCURRENCY = 20 					# concurrent sessions in the async benchmark
+REGRESSION_THRESHOLD = 0.10 			# slower than the baseline by this much = regression
+
+SAMPLE_KEY = '0123456789abcdef' * 4
+SAMPLE_MESSAGE = 'the quick brown fox jumps over the lazy dog ' * 6
+SAMPLE_CHALLENGE = ' '.join(SAMPLE_MESSAGE.split(' ')[:30])
+
+
+class Benchmark:
+	# benchmark settings
+	repeat = BENCH_REPEAT
+	min_time = BENCH_MIN_TIME
+	sessions = BENCH_SESSIONS
+	concurrency = BENCH_CONCURRENCY
+	threshold = REGRESSION_THRESHOLD
+	only = '' 				# run only the benchmarks whose name contains this
+	micro = True
+	macro = True
+
+	# files
+	output = 'bench-results.json'
+	baseline = ''
+
+	results = {} 			# name --> result dict
+	regressions = []
+
+	# error handling
+	error = False
+	error_msg = ''
+
+	ui = None
+
+	def __init__(self):
+		self.error = False
+		self.ui = UI(False)
+		self.results = {}
+		self.regressions = []
+
+	def start(self, args):
+		'''
+		Validate the arguments, run the benchmarks, write the results
+		and compare them against the baseline (if given).
+		'''
+		if not self.validateArgs(args):
+			return
+
+		if self.micro:
+			self.ui.info("Micro benchmarks (best of {} runs)".format(self.repeat))
+			self.runMicro()
+			self.ui.emptyLine()
+
+		if self.macro:
+			self.ui.info("Macro benchmarks ({} sessions per run)".format(self.sessions))
+			self.runMacro()
+			self.ui.emptyLine()
+
+		self.write()
+
+		if self.baseline:
+			self.compare()
+
+
+	#--------------------------------------------------
+	# 				MICRO BENCHMARKS
+	#--------------------------------------------------
+	# Each benchmark is a function that is called in a loop.
+	#--------------------------------------------------
+
+	def runMicro(self):
+		'''
+		Run the micro benchmarks.
+		'''
+		log = Log(SilentUI(False), False)
+		ui = UI(False)
+		client = Client()
+
+		udp = UDPConnection('ABCD1234', '127.0.0.1', 0, log)
+		udp.enableMultipart(64)
+		udp.enableEncryption([SAMPLE_KEY], [SAMPLE_KEY])
+		udp.close()
+
+		# keys are consumed, so each call starts over from the first one
+		def encrypt():
+			udp.enc_keys_en.cursor = 0
+			udp._UDPConnection__encrypt(message)
+
+		def decrypt():
+			udp.enc_keys_de.cursor = 0
+			udp._UDPConnection__decrypt(message)
+
+		message = SAMPLE_MESSAGE[:64].encode(ENCODING)
+		msg_par = udp._UDPConnection__addParity(message)
+		packet = bytes(udp.pack('ABCD1234', True, False, 0, len(message), message))
+
+		self.measure('udp.pack', lambda: udp.pack('ABCD1234', True, False, 0, 64, message))
+		self.measure('udp.unpack', lambda: udp.unpack(packet))
+		self.measure('udp.encrypt', encrypt)
+		self.measure('udp.decrypt', decrypt)
+		self.measure('udp.addParity', lambda: udp._UDPConnection__addParity(message))
+		self.measure('udp.checkParity', lambda: udp._UDPConnection__checkParity(msg_par, 64))
+		self.measure('udp.partition', lambda: udp._UDPConnection__partition(SAMPLE_MESSAGE.encode(ENCODING)))
+		self.measure('client.challengeSolver', lambda: client.challengeSolver(SAMPLE_CHALLENGE))
+		self.measure('client.generateKeyset', client.generateKeyset)
+		self.measure('ui.wrapText', lambda: ui.wrapText(SAMPLE_MESSAGE))
+		self.measure('ui.text', lambda: ui.text(SAMPLE_MESSAGE, noPrint=True))
+		self.measure('ui.text.uncached', lambda: (UI.render.cache_clear(), ui.text(SAMPLE_MESSAGE, noPrint=True)))
+
+		# rendered and written to the console (well, /dev/null)
+		console = Client()
+		console.ui = UI(True)
+		console.ui.stream = open(os.devnull, 'w')
+
+		self.measure('ui.splash', console.splash)
+		self.measure('ui.challenge', lambda: console.answerChallenge(SAMPLE_CHALLENGE, False))
+
+		# ...by a background thread
+		console.ui.enableAsync('block')
+		self.measure('ui.challenge.async', lambda: console.answerChallenge(SAMPLE_CHALLENGE, False))
+		console.ui.close()
+
+		console.ui.stream.close()
+
+		# an event that is ignored or traced (written in the background)
+		tracer = Tracer(os.devnull)
+		traced = Log(SilentUI(False), False, tracer)
+
+		self.measure('log.sent', lambda: log.sent(True, 0, 64, message, 'UDP'))
+		self.measure('log.sent.traced', lambda: traced.sent(True, 0, 64, message, 'UDP'))
+
+		tracer.close()
+
+		return
+
+	def measure(self, name, func):
+		'''
+		Time @func: first find out how many calls take at least
+		@self.min_time, then time that many calls @self.repeat times.
+		'''
+		if self.only not in name: return
+
+		# calibrate
+		loops = 1
+		while True:
+			elapsed = self.timeLoops(func, loops)
+			if elapsed >= self.min_time: break
+			loops = loops * 10 if elapsed < self.min_time / 10 else int(loops * 1.2 * self.min_time / elapsed) + 1
+
+		runs = [self.timeLoops(func, loops) / loops for k in range(self.repeat)]
+
+		self.record(name, 'ns/op', [1e9 * run for run in runs], loops=loops)
+		return
+
+	def timeLoops(self, func, loops):
+		'''
+		Seconds it takes to call @func @loops times.
+		'''
+		started = time.perf_counter()
+
+		for k in range(loops):
+			func()
+
+		return time.perf_counter() - started
+
+
+	#--------------------------------------------------
+	# 				MACRO BENCHMARKS
+	#--------------------------------------------------
+	# Whole sessions against a local server, which runs
+	# in a background thread.
+	#--------------------------------------------------
+
+	def runMacro(self):
+		'''
+		Run the macro benchmarks.
+		'''
+		server = ReferenceServer(SilentUI(False))
+		server.seed = 1
+		server.startInThread()
+
+		for opts in ('n', 'emp'):
+			self.measureSessions('session.' + opts, server.tcp_port, opts)
+
+		# TCP connections kept open between the sessions
+		pool = TCPPool()
+		self.measureSessions('session.emp.pooled', server.tcp_port, 'emp', pool)
+		pool.close()
+
+		self.measureConcurrent('sessions.async.emp', server.tcp_port, 'emp')
+
+		server.stopThread()
+		return
+
+	def measureSessions(self, name, port, opts, pool=None):
+		'''
+		Time sessions of the (blocking) Client one after another.
+		The TCP connections are taken from @pool, if given.
+		'''
+		if self.only not in name: return
+
+		runs = []
+
+		for k in range(self.repeat):
+			started = time.perf_counter()
+
+			for s in range(self.sessions):
+				client = Client()
+				client.ui = SilentUI(False)
+				client.tcp_pool = pool
+				client.start([name, '127.0.0.1', str(port), opts, '0'])
+
+				if client.error:
+					self.ui.warning("{}: {}".format(name, client.error_msg.strip()))
+
+			runs.append(1e3 * (time.perf_counter() - started) / self.sessions)
+
+		self.record(name, 'ms/session', runs, loops=self.sessions)
+		return
+
+	def measureConcurrent(self, name, port, opts):
+		'''
+		Time concurrent sessions of the AsyncClient (the load generator's
+		sessions). Also records the latency percentiles of the round trips.
+		'''
+		if self.only not in name: return
+
+		runs = []
+		phases = {phase: Histogram() for phase in PHASES}
+
+		async def batch():
+			sessions = [LoadSession('127.0.0.1', port, opts, phases) for s in range(self.sessions)]
+			limit = asyncio.Semaphore(self.concurrency)
+
+			async def run(session):
+				async with limit:
+					await session.run()
+					session.close()
+
+			await asyncio.gather(*[run(session) for session in sessions])
+
+		for k in range(self.repeat):
+			started = time.perf_counter()
+			asyncio.run(batch())
+			runs.append(1e3 * (time.perf_counter() - started) / self.sessions)
+
+		self.record(name, 'ms/session', runs, loops=self.sessions, round_trip=phases['round_trip'].summary())
+		return
+
+
+	#--------------------------------------------------
+	# 					RESULTS
+	#--------------------------------------------------
+
+	def record(self, name, unit, runs, **extra):
+		'''
+		Save and print the result of a benchmark. Lower is better.
+		'''
+		self.results[name] = dict({
+			'unit': unit,
+			'best': min(runs),
+			'median': statistics.median(runs),
+			'runs': runs,
+		}, **extra)
+
+		self.ui.text("{:<24}{:>12.1f} {:<11}(median {:.1f})".format(name, min(runs), unit, statistics.median(runs)), leftPad=7, wrap=False, noSpace=True)
+		return
+
+	def write(self):
+		'''
+		Write the results to @self.output as JSON.
+		'''
+		data = {
+			'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+			'python': platform.python_version(),
+			'platform': platform.platform(),
+			'repeat': self.repeat,
+			'results': self.results,
+		}
+
+		with open(self.output, 'w') as file:
+			json.dump(data, file, indent=2)
+
+		self.ui.info_ok("Results written to {}".format(self.output))
+		return
+
+	def compare(self):
+		'''
+		Compare the best times against the baseline results. A benchmark
+		that got slower by more than @self.threshold is a regression.
+		'''
+		try:
+			with open(self.baseline) as file:
+				baseline = json.load(file)['results']
+		except (OSError, ValueError, KeyError):
+			return self.setError("Can't read the baseline from {}".format(self.baseline))
+
+		self.ui.info("Compared to {}".format(self.baseline))
+		self.regressions = []
+
+		for name, result in self.results.items():
+			if name not in baseline: continue
+
+			change = result['best'] / baseline[name]['best'] - 1
+
+			if change > self.threshold:
+				self.regressions.append(name)
+				self.ui.text("{:<24}{:>+8.1%}  REGRESSION".format(name, change), clr='red', leftPad=7, wrap=False, noSpace=True)
+			else:
+				self.ui.text("{:<24}{:>+8.1%}".format(name, change), leftPad=7, wrap=False, noSpace=True)
+
+		self.ui.emptyLine()
+
+		if self.regressions:
+			return self.setError("{} benchmark(s) regressed more than {:.0%}: {}".format(
+				len(self.regressions), self.threshold, ', '.join(self.regressions)
+			))
+
+		return True
+
+	def validateArgs(self, args):
+		'''
+		Usage: [--only=NAME] [--micro] [--macro] [--repeat=N] [--min-time=S]
+		[--sessions=N] [--output=FILE] [--baseline=FILE] [--threshold=F] [--ansi=0]
+		'''
+		positional, flags = parse_flags(args)
+		filename = positional[0]
+
+		try:
+			self.only = str(flags.get('only', self.only))
+			self.repeat = int(flags.get('repeat', self.repeat))
+			self.min_time = float(flags.get('min-time', self.min_time))
+			self.sessions = int(flags.get('sessions', self.sessions))
+			self.output = str(flags.get('output', self.output))
+			self.baseline = str(flags.get('baseline', self.baseline))
+			self.threshold = float(flags.get('threshold', self.threshold))
+
+			ansi = int(flags.get('ansi', 1)) != 0
+
+			# only one kind, if asked
+			if 'micro' in flags or 'macro' in flags:
+				self.micro = 'micro' in flags
+				self.macro = 'macro' in flags
+
+			if self.repeat < 1 or self.min_time <= 0 or self.sessions < 1 or self.threshold < 0:
+				raise ValueError()
+
+		except Exception:
+			return self.setError("Invalid arguments!\n_______\tusage: {} [--only=NAME] [--micro] [--macro] [--repeat=N] [--min-time=S] [--sessions=N] [--output=FILE] [--baseline=FILE] [--threshold=F] [--ansi=0]".format(filename))
+
+		if ansi:
+			self.ui.enableANSI()
+
+		return True
+
+	def setError(self, msg):
+		'''
+		Sets an error, see Client.setError().
+		'''
+		self.error_msg = self.ui.error(msg, noPrint=True)
+		self.error = True
+
+		return False
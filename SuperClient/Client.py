@@ -1,9 +1,19 @@
+import threading
+import time
+
 from SuperClient.Communication import *
 from SuperClient.Log import Log
-from SuperClient.UI import UI
-from random import random
-
-MULTIPART_LEN = 64
+from SuperClient.Metrics import metrics
+from SuperClient.Profile import Profiler
+from SuperClient.Trace import Tracer
+from SuperClient.Entropy import entropy
+from SuperClient.UI import UI, UI_BACKENDS, SINK_CAPACITY, SINK_POLICIES
+from SuperClient.utils import parse_flags
+
+MULTIPART_LEN = MULTIPART_AUTO 			# fill the datagrams as far as the options allow
+REKEY_LOW_WATER = 5 					# fewer keys left --> wait for the new ones (fetched at twice this)
+REKEY_TIMEOUT = 5.0 					# wait for new keys at most this long (s)
+PROFILE_EVERY = 10 						# profile snapshot every this many challenges
 
 class Client:
 	# client meta
@@ -19,6 +29,7 @@ class Client:
 	# connection handles
 	tcp = None
 	udp = None
+	tcp_pool = None 		# TCPPool to take TCP connections from (optional)
 
 	# options
 	opt_enc = False
@@ -35,12 +46,43 @@ class Client:
 	ERR_TCP_CONN = 3
 	ERR_UDP_RESPONSE = 4
 
+	# UDP retransmission settings
+	udp_timeout = UDP_TIMEOUT
+	udp_retries = UDP_RETRIES
+
 	# encryption settings
 	keyset_len = 20
 	keyset_en = []
 	keyset_de = []
 
+	# rekeying: new keys are fetched over TCP before the old ones run out
+	rekey = False
+	rekey_low_water = REKEY_LOW_WATER
+	rekey_job = None 		# thread (or task) fetching new keys
+	rekey_keys = None 		# (keys_en, keys_de) fetched, not yet in use
+	rekey_stopped = False 	# the server didn't give new keys, don't ask again
+	keysync = False 		# keep the keys in step when datagrams are lost (SYNC extension)
+
 	verbose = False
+	ui_queue = '' 			# overflow policy of the background output (--ui-queue)
+	ui_queue_size = SINK_CAPACITY
+	trace_path = '' 		# write a trace of the events here (--trace)
+	tracer = None
+	metrics_path = '' 		# write the metrics here at exit (--metrics)...
+	metrics_interval = 0.0 	# ...and this often (s) meanwhile
+	profile_dir = '' 		# profile the session, reports go here (--profile)
+	profile_memory = True 	# profile memory allocations too
+	profile_every = PROFILE_EVERY
+	profiler = None 		# a Profiler can also be set before start()
+
+	# metrics (see Metrics.py), shared by all clients
+	m_params = metrics.histogram('tcp_params_seconds', "HELLO + keys exchange over TCP")
+	m_hello = metrics.histogram('udp_hello_seconds', "UDP HELLO --> first challenge")
+	m_round_trip = metrics.histogram('udp_round_trip_seconds', "Solution --> next challenge")
+	m_session = metrics.histogram('session_seconds', "Whole sessions")
+	m_completed = metrics.counter('sessions_completed', "Sessions completed")
+	m_failed = metrics.counter('sessions_failed', "Sessions that failed")
+	m_rekeys = metrics.counter('rekeys', "New keysets fetched during sessions")
 	ui = None
 	log = None
 
@@ -74,28 +116,50 @@ class Client:
 		if not self.validateArgs(args):
 			return
 
-		# construct the log class for detailed logging
-		self.log = Log(self.ui, self.verbose)
+		started = time.monotonic()
 
-		# Welcome!
-		self.splash()
+		# from here on the output may be written in the background, so
+		# every exit goes through the finally block that flushes it
+		try:
+			# construct the log class for detailed logging
+			if not self.openTrace():
+				return
 
-		self.ui.info("Fetching connection parameters...")
+			self.log = Log(self.ui, self.verbose, self.tracer)
+			self.startMetrics()
 
-		# fetch parameters from the server using TCP
-		if not self.fetchCommParams():
-			return
+			if not self.startProfile():
+				return
 
-		self.ui.info("Opening UDP connection...")
-		
-		# jump to the "main" loop!
-		if not self.UDPLoop():
-			return
+			# Welcome!
+			self.splash()
 
-		self.ui.info("Exchange over, quitting...\n")
+			self.ui.info("Fetching connection parameters...")
 
-		# successfully went through the pipeline!
-		self.shutdown()
+			# fetch parameters from the server using TCP
+			if not self.fetchCommParams():
+				return
+
+			self.ui.event('handshake', cid=self.cid, udp_port=self.srv_udp_port, encryption=self.opt_enc, multipart=self.opt_mul, parity=self.opt_par)
+			self.profilePhase('params')
+
+			self.ui.info("Opening UDP connection...")
+			
+			# jump to the "main" loop!
+			if not self.UDPLoop():
+				return
+
+			self.ui.info("Exchange over, quitting...\n")
+
+			# successfully went through the pipeline!
+			self.shutdown()
+
+		finally:
+			self.endSession(time.monotonic() - started)
+			self.stopProfile()
+			self.closeTrace()
+			self.closeMetrics()
+			self.closeOutput()
 
 
 	#--------------------------------------------------
@@ -115,46 +179,61 @@ class Client:
 		self.udp = UDPConnection(self.cid, self.srv_address, self.srv_udp_port, self.log)
 
 		# enable UDP extra features
-		if self.opt_enc: self.udp.enableEncryption(self.keyset_en, self.keyset_de)
-		if self.opt_mul: self.udp.enableMultipart(MULTIPART_LEN)
-		if self.opt_par: self.udp.enableParityCheck()
+		self.setupUDP()
 
 		# From now on, UDPConnection class takes care of
 		# encrypting, decrypting, partitioning etc.
 
 		# send initial UDP message
-		self.udp.send('HELLO from ' + self.cid)
+		self.udp.send(('HELLO from ' + self.cid).encode(ENCODING))
 
 		# show some progress
 		self.ui.info_ok("Success")
 		self.ui.info("Waiting for challenges...")
 
+		# the first response is to the HELLO
+		round_trip = self.m_hello
+		challenges = 0
+
 		# this loop receives challenges from server, comes up with a 'solution'
 		# and sends it back until server ends the session
 		while True:
 
-			# receive a message
-			challenge, eom = self.udp.receive()
-
-			# pass the challenge to a solver and get a solution (reverse order)
-			solution = self.challengeSolver(challenge)
+			# receive a message, give up if the server stops responding
+			try:
+				message, eom = self.udp.receive()
+			except RetransmissionError:
+				self.udp.close()
+				self.closeControl()
+				return self.setError(self.ERR_UDP_RESPONSE)
+
+			round_trip.record(time.monotonic() - self.udp.sent_at)
+			round_trip = self.m_round_trip
+			challenges += 1
+
+			# profile snapshot every now and then
+			if challenges % self.profile_every == 0 and not eom:
+				self.profilePhase('challenge-{}'.format(challenges))
+
+			# the messages are bytes until here, then pass the challenge
+			# to a solver and get a solution (reverse order)
+			challenge = message.decode(ENCODING, 'replace')
+			solution = self.answerChallenge(challenge, eom)
 			
 			# End Of Messaging --> break the loop
-			if eom:
-				self.ui.text(f" Server: \"{challenge}\"\n", leftPad=7, wrap=False)
-				self.ui.resetNumbering()
-				break
-
-			# if not last message, answer to the challenge and keep going
-			self.ui.numbered("Challenge accepted:")
-			self.ui.indented("»", f"\"{challenge}\"")
-			self.ui.indented("«", f"\"{solution}\"\n",)
+			if eom: break
+
+			data = solution.encode(ENCODING)
+
+			# fetch new keys before they run out
+			self.checkKeys(data)
 		
 			# send the solution back to the server (word reversed)
-			self.udp.send(solution)
+			self.udp.send(data)
 
 		# Success! Close the connection and leave.
 		self.udp.close()
+		self.closeControl()
 		return True
 
 
@@ -164,6 +243,7 @@ class Client:
 		as well as setting them as class variables.
 		Invalid arguments causes an error to be set.
 		'''
+		args, flags = parse_flags(args)
 		self.filename = args[0]
 		disableANSI = False
 
@@ -172,20 +252,47 @@ class Client:
 			self.srv_address = str(args[1])
 			self.srv_tcp_port = int(args[2])
 
+			# --ui=jsonl|silent: JSON lines for automation or no output at all
+			if 'ui' in flags:
+				self.ui = UI_BACKENDS[str(flags['ui'])](False)
+
+			# --ui-queue[=drop|coalesce|block] [--ui-queue-size=N]: write the output in the background
+			if 'ui-queue' in flags:
+				self.ui_queue = 'drop' if flags['ui-queue'] is True else str(flags['ui-queue'])
+				self.ui_queue_size = int(flags.get('ui-queue-size', self.ui_queue_size))
+
+				if self.ui_queue not in SINK_POLICIES or self.ui_queue_size < 1: raise ValueError()
+
+			# --trace=FILE: trace the events to a file
+			if 'trace' in flags:
+				self.trace_path = str(flags['trace'])
+
+			# --profile=DIR [--profile-every=N] [--profile-memory=0]: profile the session
+			if 'profile' in flags:
+				self.profile_dir = str(flags['profile'])
+				self.profile_every = int(flags.get('profile-every', self.profile_every))
+				self.profile_memory = int(flags.get('profile-memory', 1)) != 0
+
+				if self.profile_every < 1: raise ValueError()
+
+			# --metrics=FILE [--metrics-interval=S]: export the metrics
+			if 'metrics' in flags:
+				self.metrics_path = str(flags['metrics'])
+				self.metrics_interval = float(flags.get('metrics-interval', 0))
+
+			# --rekey[=N]: never go below N keys (new ones are fetched at 2N)
+			if 'rekey' in flags:
+				self.rekey = True
+				if flags['rekey'] is not True:
+					self.rekey_low_water = int(flags['rekey'])
+
+			# --keysync: ask the server to keep the keys in step when datagrams are lost
+			if 'keysync' in flags:
+				self.keysync = True
+
 			# options (optional, heh)
 			if len(args) >= 4:
-				opts = str(args[3])
-
-				if ('n' in opts) or ('N' in opts):
-					# set all options off
-					self.opt_enc = False
-					self.opt_mul = False
-					self.opt_par = False
-				else:
-					# set options individually
-					self.opt_enc = ('e' in opts) or ('E' in opts)
-					self.opt_mul = ('m' in opts) or ('M' in opts)
-					self.opt_par = ('p' in opts) or ('P' in opts)
+				self.setOptions(str(args[3]))
 
 			if len(args) >= 5:
 				# enable
@@ -197,6 +304,9 @@ class Client:
 
 		if not disableANSI:
 			self.ui.enableANSI()
+
+		if self.ui_queue:
+			self.ui.enableAsync(self.ui_queue, self.ui_queue_size)
 		
 		return True
 
@@ -210,51 +320,263 @@ class Client:
 
 		# 1. Setup Connection
 
-		self.tcp = TCPConnection(self.srv_address, self.srv_tcp_port, self.log)
+		# build up the request
+		request = self.buildRequest()
+		fresh = False
+
+		while True:
+			if not self.openTCP(fresh):
+				return False
+
+			# 2. Fetch the Parameters
+
+			started = time.monotonic()
+
+			try:
+				response = self.requestCommParams(request)
+			except OSError:
+				response = []
+
+			self.m_params.record(time.monotonic() - started)
+
+			# a pooled connection may have been closed by the server
+			# meanwhile, in that case try once more with a new one
+			if self.tcp.reused and not self.responseComplete(response):
+				self.tcp.close()
+				fresh = True
+				continue
+
+			break
+
+
+		# 3. Handle the Response
+
+		if not self.applyCommParams(response):
+			self.closeTCP(False)
+			return False
 
+		# we are done here, close the connection (or keep it for the next session)
+		# unless it's needed for rekeying later
+		if not (self.rekey and self.opt_enc):
+			self.closeTCP(True)
+
+		return True
+
+
+	def openTCP(self, fresh=False):
+		'''
+		Connects to the server, or takes a connection from @self.tcp_pool
+		if there is one (a new one if @fresh is set).
+		'''
 		try:
-			# connect socket to given address and port
-			self.tcp.connectToServer()
+			if self.tcp_pool is not None:
+				self.tcp = self.tcp_pool.acquire(self.srv_address, self.srv_tcp_port, self.log, fresh)
+			else:
+				# connect socket to given address and port
+				self.tcp = TCPConnection(self.srv_address, self.srv_tcp_port, self.log)
+				self.tcp.connectToServer()
+
 		except ConnectionRefusedError:
 			# catch the exception if the connection refuses, exit
 			return self.setError(self.ERR_TCP_CONN)
 
-		# build up the request
-		request = ['HELLO']
-
-		# join optional arguments to the initial message
-		if self.opt_enc: request[0] += ' ENC'
-		if self.opt_mul: request[0] += ' MUL'
-		if self.opt_par: request[0] += ' PAR'
+		return True
 
-		# connection ok, generate a keyset if needed
-		if self.opt_enc:
-			self.keyset_en = self.generateKeyset()
-			request += self.keyset_en + ['.']
+	def requestCommParams(self, request):
+		'''
+		Sends the request and receives the response (a list of messages).
+		'''
 
-		
-		# 2. Fetch the Parameters
-		
 		# send the initial message + keys
-		# TCPConnection.send() takes in a list of messages to be transmitted
-		self.tcp.send(request)
+		# TCPConnection.send() takes in a list of messages to be transmitted.
+		# On a pooled connection, end the request with a delimiter so that
+		# the server doesn't need to guess where it ends.
+		self.tcp.send(request + [''] if self.tcp_pool is not None else request)
 
 		# receive the parameters + keys
 		response = []
-		while True:
 
-			# TCPConnection.receive() automatically disassembles the response into messages
-			response += self.tcp.receive()
+		# TCPConnection.messages() yields the messages as they arrive. Without
+		# encryption the response is a single message, which might not be
+		# followed by a delimiter, so don't wait for one for long.
+		for message in self.tcp.messages(0.0 if self.opt_enc else TCP_TAIL_GRACE):
+			response.append(message)
 
-			# end of transmission is based on opt_enc option:
-			# IF no encryption is used, end after one message,
-			# OTHERWISE wait until a message with only dot ('.') is received
-			if self.opt_enc and '.' not in response: continue
-			
-			break
+			if self.responseComplete(response): break
 
+		return response
 
-		# 3. Handle the Response
+	def closeTCP(self, reusable):
+		'''
+		Closes the TCP connection, or gives it back to @self.tcp_pool
+		if there is one and the connection is @reusable.
+		'''
+		if self.tcp_pool is not None and reusable:
+			self.tcp_pool.release(self.tcp)
+			self.tcp = None
+		else:
+			self.tcp.close()
+
+		return
+
+
+	#--------------------------------------------------
+	# 				   REKEYING
+	#--------------------------------------------------
+	# When enabled (@self.rekey), the TCP connection is kept
+	# open during the session and new keysets are exchanged
+	# over it in the background:
+	#   client --> "REKEY <cid>" + keys + "."
+	#   server --> "REKEY <cid>" + keys + "."
+	# Both sides append the new keys to their keystreams.
+	# -------------------------------------------------
+
+	def checkKeys(self, message):
+		'''
+		Called between messages, before sending @message. Takes the fetched
+		keys into use, or starts fetching new ones if the keys are running low.
+		'''
+		if not (self.rekey and self.opt_enc) or self.rekey_stopped: return
+
+		# the new keys are needed right away
+		if self.rekeyDue(message):
+			self.rekey_job.join(REKEY_TIMEOUT)
+
+			# no answer in time, don't wait for one again
+			if self.rekey_keys is None:
+				self.stopRekey()
+				return
+
+		self.updateKeys()
+		return
+
+	def rekeyDue(self, message):
+		'''
+		Tells if new keys are being fetched and the keys left would run out
+		before they arrive: both sides must have the new keys before the
+		keys of the next round trip (@message and the response) run out,
+		otherwise the keystreams get out of sync.
+		'''
+		if self.rekey_job is None or self.rekey_keys is not None: return False
+
+		needed = max(self.rekey_low_water, -(-len(message) // self.udp.mul_len))
+
+		return min(len(self.udp.enc_keys_en), len(self.udp.enc_keys_de)) < needed
+
+	def updateKeys(self):
+		'''
+		Takes the fetched keys into use or starts fetching new ones.
+		'''
+
+		# new keys have arrived
+		if self.rekey_keys is not None:
+			keys_en, keys_de = self.rekey_keys
+			self.rekey_keys = None
+			self.rekey_job = None
+
+			if keys_de is None:
+				# the server doesn't do rekeying, don't try again
+				self.stopRekey()
+				return
+
+			self.udp.enc_keys_en.extend(keys_en)
+			self.udp.enc_keys_de.extend(keys_de)
+			self.m_rekeys.inc()
+			self.log.rekeyed(len(keys_en))
+			return
+
+		if self.rekey_job is not None: return
+
+		if min(len(self.udp.enc_keys_en), len(self.udp.enc_keys_de)) <= 2 * self.rekey_low_water:
+			self.startRekey(self.generateKeyset())
+
+		return
+
+	def stopRekey(self):
+		'''
+		Stop rekeying for the rest of the session, the keys will run out.
+		'''
+		self.rekey_stopped = True
+		self.log.rekey_failed()
+
+		return
+
+	def startRekey(self, keys_en):
+		'''
+		Fetch new keys in a background thread.
+		'''
+		self.rekey_job = threading.Thread(target=self.fetchKeys, args=(keys_en,), daemon=True)
+		self.rekey_job.start()
+
+		return
+
+	def fetchKeys(self, keys_en):
+		'''
+		Runs in the background: sends our new keys and receives the server's.
+		The keys are left in @self.rekey_keys for checkKeys(), so that the
+		keystreams are only touched between messages. A server that doesn't
+		answer in REKEY_TIMEOUT doesn't do rekeying.
+		'''
+		keys_de = None
+
+		try:
+			self.tcp.send(self.buildRekey(keys_en))
+
+			response = []
+			for message in self.tcp.messages(timeout=REKEY_TIMEOUT):
+				response.append(message)
+				if self.rekeyComplete(response): break
+
+			keys_de = self.parseRekey(response)
+
+		except OSError:
+			pass
+
+		self.rekey_keys = (keys_en, keys_de)
+
+	def closeControl(self):
+		'''
+		Close the TCP connection kept open for rekeying (or give it back to
+		the pool). If a rekey is still going on or has failed, the connection
+		is closed.
+		'''
+		if not (self.rekey and self.opt_enc) or self.tcp is None: return
+
+		if self.rekey_stopped or (self.rekey_job is not None and self.rekey_keys is None):
+			self.closeTCP(False)
+			if self.rekey_job is not None: self.rekey_job.join(1.0)
+		else:
+			self.closeTCP(True)
+
+		return
+
+	def buildRekey(self, keys_en):
+		'''
+		Builds a REKEY request (a list of messages).
+		'''
+		return ['REKEY ' + self.cid] + keys_en + [MSG_END, '']
+
+	def rekeyComplete(self, response):
+		'''
+		Tells if the whole REKEY response has been received.
+		'''
+		return response[-1] == MSG_END or not response[0].startswith('REKEY')
+
+	def parseRekey(self, messages):
+		'''
+		Validate a REKEY response. Returns the keys, None if the response was invalid.
+		'''
+		if len(messages) != self.keyset_len + 2: return None
+		if messages[0] != 'REKEY ' + self.cid or messages[-1] != MSG_END: return None
+
+		return messages[1:-1]
+
+
+	def applyCommParams(self, response):
+		'''
+		Parses the TCP response and takes the communication parameters
+		into use. Sets an error if the response was invalid.
+		'''
 
 		# parse response
 		valid_parsed_response = self.parseCommParams(response)
@@ -268,15 +590,16 @@ class Client:
 
 		self.srv_udp_port = port
 		self.cid = cid
+		self.log.session = cid
+
+		# key sync only if the server agreed to it
+		self.keysync = self.keysync and 'SYNC' in response[0].split(' ')[3:]
 
 		# save the received decoding keyset
 		if self.opt_enc:
 			self.keyset_de = keys
 
 		self.ui.info_ok("Successful TCP response from server: CID: {}, UDP port: {}".format(self.cid, self.srv_udp_port))
-
-		# we are done here, close the connection
-		self.tcp.close()
 		return True
 
 
@@ -286,11 +609,87 @@ class Client:
 	# Various helper methods for wrapping common tasks.
 	#--------------------------------------------------
 
+	def setOptions(self, opts):
+		'''
+		Set the extra features from an option string, e.g. 'emp' or 'n'.
+		See README for details.
+		'''
+		if ('n' in opts) or ('N' in opts):
+			# set all options off
+			self.opt_enc = False
+			self.opt_mul = False
+			self.opt_par = False
+		else:
+			# set options individually
+			self.opt_enc = ('e' in opts) or ('E' in opts)
+			self.opt_mul = ('m' in opts) or ('M' in opts)
+			self.opt_par = ('p' in opts) or ('P' in opts)
+
+		return
+
+	def buildRequest(self):
+		'''
+		Builds the initial TCP request (a list of messages): HELLO with the
+		selected options and the encryption keyset, if needed.
+		'''
+		request = ['HELLO']
+
+		# join optional arguments to the initial message
+		if self.opt_enc: request[0] += ' ENC'
+		if self.opt_mul: request[0] += ' MUL'
+		if self.opt_par: request[0] += ' PAR'
+
+		# an extension, see UDPConnection.enableKeySync()
+		if self.opt_enc and self.keysync: request[0] += ' SYNC'
+
+		# generate a keyset if needed
+		if self.opt_enc:
+			self.keyset_en = self.generateKeyset()
+			request += self.keyset_en + ['.']
+
+		return request
+
+	def responseComplete(self, response):
+		'''
+		Tells if the whole TCP response (a list of messages) has been received.
+		Called after each received message, so only the latest one is checked.
+		'''
+		# end of transmission is based on opt_enc option:
+		# IF no encryption is used, end after one message,
+		# OTHERWISE wait until a message with only dot ('.') is received
+		if not response: return False
+		if self.opt_enc and response[-1] != MSG_END: return False
+
+		return True
+
+	def setupUDP(self):
+		'''
+		Enables the selected extra features of the UDP connection.
+		'''
+		if self.opt_enc: self.udp.enableEncryption(self.keyset_en, self.keyset_de)
+		if self.opt_enc and self.keysync: self.udp.enableKeySync()
+		if self.opt_mul: self.udp.enableMultipart(MULTIPART_LEN)
+		if self.opt_par: self.udp.enableParityCheck()
+		self.udp.enableTimeouts(self.udp_timeout, self.udp_retries)
+
+		return
+
+	def answerChallenge(self, challenge, eom):
+		'''
+		Solves a challenge received from the server and shows it to the user.
+		Returns the solution. The last message (@eom) is only shown.
+		'''
+		solution = self.challengeSolver(challenge)
+		self.ui.challenge(challenge, solution, eom)
+
+		return solution
+
 	def splash(self):
 		'''
 		Prints a heart-warming welcome before the shell fills of error traces.
 		Using a home-made "UI library".
 		'''
+		self.ui.beginBlock()
 		self.ui.borderStart()
 		
 		self.ui.logo()
@@ -329,6 +728,120 @@ class Client:
 		self.ui.borderEnd()
 		self.ui.horLine(noPadding=True)
 		self.ui.emptyLine()
+		self.ui.endBlock()
+		return
+
+	def openTrace(self):
+		'''
+		Start tracing if asked to (see Trace.py).
+		'''
+		if not self.trace_path: return True
+
+		try:
+			self.tracer = Tracer(self.trace_path)
+		except OSError as e:
+			return self.setError(self.ERR_CUSTOM, "Can't write the trace: {}".format(e))
+
+		return True
+
+	def closeTrace(self):
+		'''
+		Write the rest of the trace and close it.
+		'''
+		if self.tracer is None: return
+
+		self.tracer.close()
+
+		if self.tracer.dropped:
+			self.ui.warning("{} trace records were dropped.".format(self.tracer.dropped))
+
+		return
+
+	def closeOutput(self):
+		'''
+		Write the rest of the output (and stop writing in the background).
+		'''
+		sink = self.ui.sink
+		self.ui.close()
+
+		if sink is not None and sink.dropped:
+			self.ui.warning("{} console writes were dropped.".format(sink.dropped))
+
+		return
+
+	def startMetrics(self):
+		'''
+		Start exporting the metrics periodically if asked to (see Metrics.py).
+		'''
+		if self.metrics_path and self.metrics_interval > 0:
+			metrics.exportEvery(self.metrics_path, self.metrics_interval)
+
+		return
+
+	def endSession(self, elapsed):
+		'''
+		Count the session as completed or failed.
+		'''
+		if self.error:
+			self.m_failed.inc()
+		else:
+			self.m_completed.inc()
+			self.m_session.record(elapsed)
+
+		return
+
+	def closeMetrics(self):
+		'''
+		Write the final metrics.
+		'''
+		if not self.metrics_path: return
+
+		metrics.stopExport()
+
+		try:
+			metrics.write(self.metrics_path)
+		except OSError as e:
+			self.setError(self.ERR_CUSTOM, "Can't write the metrics: {}".format(e))
+
+		return
+
+	def startProfile(self):
+		'''
+		Start profiling the session if asked to (see Profile.py).
+		'''
+		if self.profile_dir and self.profiler is None:
+			self.profiler = Profiler(self.profile_dir, memory=self.profile_memory)
+
+		if self.profiler is None: return True
+
+		try:
+			self.profiler.start()
+		except OSError as e:
+			return self.setError(self.ERR_CUSTOM, "Can't write the profile: {}".format(e))
+
+		return True
+
+	def profilePhase(self, name):
+		'''
+		A phase of the session is over: take profile snapshots.
+		'''
+		if self.profiler is not None:
+			self.profiler.phase(name)
+
+		return
+
+	def stopProfile(self):
+		'''
+		Stop profiling and write the reports.
+		'''
+		if self.profiler is None or not self.profiler.running: return
+
+		try:
+			self.profiler.stop()
+		except OSError as e:
+			return self.setError(self.ERR_CUSTOM, "Can't write the profile: {}".format(e))
+
+		self.ui.info_ok("Profile written to {}".format(self.profiler.directory))
 		return
 
 	def shutdown(self):
@@ -342,29 +855,18 @@ class Client:
 
 	def generateKeyset(self):
 		'''
-		Takes care of generating a new keyset for encryption. The keys 
-		themselves are generated in another method so it's easily changeable.
+		Takes care of generating a new keyset for encryption. The keys are
+		cut from one block of the shared entropy pool (see Entropy.py), the
+		bytes come from the operating system's CSPRNG.
 		'''
-
-		keys = []
-		for i in range(self.keyset_len):
-			keys.append( self.generateEncryptionKey() )
-
-		return keys
+		return entropy.keyset(self.keyset_len)
 
 	def generateEncryptionKey(self):
 		'''
-		Generate a single key using pseudo-random function. Here you
+		Generate a single key (64 random hex characters). Here you
 		can implement any other key generator if you like.
 		'''
-		chars = ['0','1','2','3','4','5','6','7','8','9','a','b','c','d','e','f']
-
-		words = []
-		key_chars = [
-			chars[int((100*random()) % 16)] * 64
-		]
-
-		return ''.join(key_chars)
+		return entropy.keyset(1)[0]
 
 
 	def parseCommParams(self, messages):
@@ -437,7 +939,7 @@ class Client:
 		if err_code == self.ERR_CUSTOM:
 			msg = "Custom error message: \"{}\"".format(msg)
 		elif err_code == self.ERR_INVALID_ARGS:
-			msg = "Invalid arguments!\n_______\tusage: {} <server address> <server port> <options> <ansi>".format(self.filename)
+			msg = "Invalid arguments!\n_______\tusage: {} <server address> <server port> <options> <ansi> [--ui=human|jsonl|silent] [--ui-queue[=drop|coalesce|block]] [--ui-queue-size=N] [--rekey[=N]] [--keysync] [--trace=FILE] [--metrics=FILE] [--metrics-interval=S] [--profile=DIR] [--profile-every=N] [--profile-memory=0]".format(self.filename)
 		elif err_code == self.ERR_TCP_CONN:
 			msg = "TCP connection refused. Please check your address and port."
 		elif err_code == self.ERR_TCP_RESPONSE:
@@ -449,5 +951,6 @@ class Client:
 
 		self.error_msg = self.ui.error(msg, noPrint=True)
 		self.error = True
+		self.ui.event('error', code=err_code, message=msg)
 
 		return False
@@ -0,0 +1,416 @@
+'''
+	SuperClient/Codec.py
+	This file contains the byte-level building blocks used by the connection
+	classes: ciphers, error detection and so on. Everything in here works on
+	bytes-like objects (bytes, bytearray, memoryview) so that whole fragments
+	can be processed in one go instead of one character at a time.
+'''
+
+import struct
+from collections import deque
+
+KEY_ENCODING = 'ascii' 					# keys are hex strings, one byte per char
+
+
+class Keystream:
+	'''
+	Symmetric XOR cipher with a keyset stored as one contiguous buffer of key
+	bytes. Each call of xor() uses the next key, a cursor tells where it
+	starts, so running out of keys is just the cursor reaching the end.
+	len() is the number of keys left.
+
+	The data and the key are turned into big integers so that the whole
+	fragment is XORed with a single operation instead of a Python-level
+	loop per character.
+
+	All keys must be of the same length. New keys can be appended, the used
+	keys are dropped from the buffer at the same time.
+	'''
+	buffer = None 		# the key bytes
+	key_len = 0
+	cursor = 0 			# offset of the next key
+
+	def __init__(self, keys=()):
+		self.buffer = bytearray()
+		self.key_len = 0
+		self.cursor = 0
+
+		self.extend(keys)
+
+	def __len__(self):
+		if not self.key_len: return 0
+		return (len(self.buffer) - self.cursor) // self.key_len
+
+	def extend(self, keys):
+		'''
+		Append keys (strings) to the end of the stream.
+		'''
+		keys = [key.encode(KEY_ENCODING) for key in keys]
+		if not keys: return
+
+		if not self.key_len:
+			self.key_len = len(keys[0])
+
+		if any(len(key) != self.key_len for key in keys):
+			raise ValueError("All keys must be {} characters long".format(self.key_len))
+
+		del self.buffer[:self.cursor]
+		self.buffer += b''.join(keys)
+		self.cursor = 0
+
+		return
+
+	def xor(self, data):
+		'''
+		XOR @data (bytes-like) with the beginning of the next key. Since XOR
+		is symmetrical, this is used for encrypting as well as decrypting.
+		Returns bytes of the same length as @data.
+		'''
+		start = self.cursor
+		end = start + self.key_len
+		length = len(data)
+
+		if end > len(self.buffer):
+			raise ValueError("Out of keys")
+		if length > self.key_len:
+			raise ValueError("Key is shorter than the data ({} < {})".format(self.key_len, length))
+
+		self.cursor = end
+		crypted = int.from_bytes(data, 'big') ^ int.from_bytes(self.buffer[start:start + length], 'big')
+
+		return crypted.to_bytes(length, 'big')
+
+	def skip(self, count=1):
+		'''
+		Use up @count keys (or as many as there are left) without using
+		them for anything.
+		'''
+		count = min(count, len(self))
+		self.cursor += count * self.key_len
+
+
+class ParityCodec:
+	'''
+	Even parity for 7-bit characters. Each character is shifted left by one bit
+	and its parity is stored in the lowest bit. Instead of counting bits per
+	character, everything is precomputed into 256-entry tables once so a whole
+	fragment can be handled with a single bytes.translate() pass.
+	'''
+
+	REPLACEMENT = b'?' 	# sent in place of bytes that don't fit in 7 bits
+	ENCODE = None 		# 7-bit char --> shifted char with parity bit
+	DECODE = None 		# shifted char --> 7-bit char
+	ERRORS = None 		# shifted char --> 1 if the parity bit is wrong, else 0
+
+	def __init__(self):
+		'''
+		Build the lookup tables. They're shared by all instances.
+		'''
+		if ParityCodec.ENCODE is not None: return
+
+		ParityCodec.ENCODE = bytes(
+			(c << 1) | self.parity(c) for c in (c if c < 128 else self.REPLACEMENT[0] for c in range(256))
+		)
+		ParityCodec.DECODE = bytes(c >> 1 for c in range(256))
+
+		# a valid byte always has an even number of bits set:
+		# bits of the original character + the parity bit
+		ParityCodec.ERRORS = bytes(self.parity(c) for c in range(256))
+
+		return
+
+	def encode(self, data):
+		'''
+		Add a parity bit to each byte of @data. Only 7-bit data can be encoded
+		since the shifted character must still fit in a byte: other bytes are
+		encoded as REPLACEMENT (see nonAscii()).
+		'''
+		return bytes(data).translate(self.ENCODE)
+
+	@staticmethod
+	def nonAscii(data):
+		'''
+		Count the bytes of @data that don't fit in 7 bits.
+		'''
+		if data.isascii(): return 0
+
+		return sum(1 for c in data if c >= 128)
+
+	def decode(self, data):
+		'''
+		Remove parity bits from @data. Returns a tuple containing the decoded
+		bytes and a list of offsets of the bytes that failed the check.
+		If the list is empty, the data was valid.
+		'''
+		# translate() is only for bytes: a memoryview (of a receive buffer)
+		# is copied here, bytes are used as they are
+		data = bytes(data)
+		checks = data.translate(self.ERRORS)
+
+		errors = []
+		offset = checks.find(1)
+		while offset != -1:
+			errors.append(offset)
+			offset = checks.find(1, offset + 1)
+
+		return (data.translate(self.DECODE), errors)
+
+	@staticmethod
+	def parity(n):
+		'''
+		Get parity bit of given integer n.
+		'''
+		while n > 1:
+			n = (n >> 1) ^ (n & 1)
+		return n
+
+
+class Frame:
+	'''
+	A single UDP datagram in its unpacked form. Uses slots so that creating
+	(or refilling) one is cheaper than building a tuple and unpacking it.
+	'''
+	__slots__ = ('cid', 'ack', 'eom', 'remain', 'length', 'content')
+
+	def __init__(self, cid=b'', ack=False, eom=False, remain=0, length=0, content=b''):
+		self.cid = cid
+		self.ack = ack
+		self.eom = eom
+		self.remain = remain
+		self.length = length
+		self.content = content
+
+
+class FrameCodec:
+	'''
+	Packs and unpacks datagrams using precompiled structs. Packing is done
+	into a single preallocated send buffer so sending doesn't allocate anything.
+	Unpacking only parses the header, the content is returned as a memoryview
+	of the received buffer.
+	NOTE: the buffer returned by pack() is overwritten by the next call.
+	'''
+	struct = None 		# whole datagram
+	header = None 		# everything but the content
+	size = 0
+	cid = b'' 			# encoded only once
+	buffer = None 		# reusable send buffer
+
+	def __init__(self, header_fmt, content_len, cid):
+		self.struct = struct.Struct('{}{}s'.format(header_fmt, content_len))
+		self.header = struct.Struct(header_fmt)
+		self.size = self.struct.size
+		self.cid = cid
+		self.buffer = bytearray(self.size)
+
+	def pack(self, ack, eom, remain, length, content):
+		'''
+		Pack the fields into the send buffer and return the buffer.
+		@content must be bytes, it's padded with zeroes to the full length.
+		'''
+		self.struct.pack_into(self.buffer, 0, self.cid, ack, eom, remain, length, content)
+		return self.buffer
+
+	def unpack(self, packet, frame=None):
+		'''
+		Unpack a datagram into @frame (a new Frame is created if none
+		is given) and return the frame. The content is a memoryview of the
+		whole content field in @packet, so it's not copied. It is only valid
+		as long as @packet isn't reused.
+		'''
+		if len(packet) != self.size:
+			raise struct.error("Invalid datagram size: {} bytes".format(len(packet)))
+
+		if frame is None: frame = Frame()
+
+		(
+			frame.cid,
+			frame.ack,
+			frame.eom,
+			frame.remain,
+			frame.length
+		) = self.header.unpack_from(packet)
+
+		frame.content = memoryview(packet)[self.header.size:]
+
+		return frame
+
+
+class ReassemblyBuffer:
+	'''
+	Collects the fragments of a multipart message regardless of the order they
+	arrive in. A fragment doesn't tell its offset from the start, but the
+	remain field tells its offset from the end of the message: a fragment
+	covers positions [remain, remain + length) counted backwards from the end.
+
+	Received positions are tracked in a bitmap (an int, bit n = n:th position
+	from the end), which is used to drop duplicates and to tell when there are
+	no holes left. The message is complete when the last fragment (remain = 0)
+	has arrived and everything up to the furthest known position is covered.
+
+	If the previous complete message was asked again, copies of it may still
+	be on their way: its fragments are remembered so that a late duplicate of
+	one doesn't end up in the next message. Otherwise they are not, since the
+	next message may well be the same.
+
+	NOTE: the total length of a message is never sent, so if the very first
+	fragment arrives last, the rest looks like a complete (shorter) message.
+	The receiver has to hold it for a moment before taking it (see
+	UDPConnection.holdTime()). If the first fragment is lost, that can't be
+	told at all.
+	'''
+	fragments = {} 		# remain --> fragment
+	received = 0 		# bitmap of received positions
+	extent = 0 			# furthest known position (= message length so far)
+	last = False 		# has the last fragment arrived
+	valid = True 		# did all the fragments pass the checks
+	previous = set() 	# (remain, fragment) pairs of the previous message
+
+	def __init__(self):
+		self.reset()
+
+	def done(self, remember=True):
+		'''
+		The message has been consumed: get ready for the next message.
+		If @remember, copies of the message may still arrive and its
+		fragments are remembered to drop them.
+		'''
+		previous = set(self.fragments.items()) if remember else set()
+		self.reset()
+		self.previous = previous
+
+	def reset(self):
+		'''
+		Forget everything and get ready for the next message. This also
+		forgets the previous message, so call this when asking for a
+		retransmission (that will contain the same fragments again).
+		'''
+		self.previous = set()
+		self.fragments = {}
+		self.received = 0
+		self.extent = 0
+		self.last = False
+		self.valid = True
+
+	def add(self, remain, length, fragment, valid=True):
+		'''
+		Store a fragment in its place. Returns False if the fragment was
+		a duplicate and was dropped, True otherwise.
+		'''
+		mask = ((1 << length) - 1) << remain
+
+		# everything this fragment covers has been received already
+		if mask and (self.received & mask) == mask: return False
+		if not mask and remain in self.fragments: return False
+
+		# a late copy of the previous message
+		if (remain, fragment) in self.previous: return False
+
+		self.fragments[remain] = fragment
+		self.received |= mask
+		self.extent = max(self.extent, remain + length)
+
+		if remain == 0: self.last = True
+		if not valid: self.valid = False
+
+		return True
+
+	def complete(self):
+		'''
+		Tells if all the fragments of the message have arrived.
+		'''
+		return self.last and self.received == (1 << self.extent) - 1
+
+	def ordered(self):
+		'''
+		Returns the fragments in message order (first fragment first),
+		ready to be joined.
+		'''
+		return [self.fragments[remain] for remain in sorted(self.fragments, reverse=True)]
+
+
+class LineReader:
+	'''
+	Splits a stream of bytes (e.g. TCP) into messages separated by a
+	delimiter. Received bytes are kept in a buffer until the delimiter of
+	their message arrives, so messages split between reads are put back
+	together. Only complete messages are decoded, so a multi-byte character
+	split between reads is never decoded in halves (the delimiter can't
+	appear inside a multi-byte UTF-8 character).
+
+	Each received byte is searched for the delimiter only once: the search
+	continues where the previous one ended.
+	'''
+	delimiter = b'\r\n'
+	encoding = 'utf-8'
+	buffer = None 		# bytes of the incomplete message
+	scanned = 0 		# bytes of the buffer already searched for a delimiter
+	lines = None 		# complete messages not yet consumed
+	skip = False 		# drop a delimiter that ends a flushed message
+
+	def __init__(self, delimiter, encoding):
+		self.delimiter = delimiter.encode(encoding)
+		self.encoding = encoding
+		self.buffer = bytearray()
+		self.scanned = 0
+		self.lines = deque()
+		self.skip = False
+
+	def feed(self, data):
+		'''
+		Add received bytes. Returns a list of the messages they completed,
+		the messages are also queued for messages().
+		'''
+		self.buffer += data
+
+		# the delimiter of a message that was taken without it
+		if self.skip:
+			if self.buffer.startswith(self.delimiter):
+				del self.buffer[:len(self.delimiter)]
+				self.skip = False
+			elif len(self.buffer) >= len(self.delimiter) or not self.delimiter.startswith(self.buffer):
+				self.skip = False
+
+		lines = []
+		start = 0
+		search = max(0, self.scanned - len(self.delimiter) + 1)
+
+		while True:
+			end = self.buffer.find(self.delimiter, search)
+			if end < 0: break
+
+			lines.append(self.buffer[start:end].decode(self.encoding, 'replace'))
+			start = search = end + len(self.delimiter)
+
+		del self.buffer[:start]
+		self.scanned = len(self.buffer)
+		self.lines.extend(lines)
+
+		return lines
+
+	def messages(self):
+		'''
+		Generator that yields the complete messages. Messages that
+		are not consumed stay queued.
+		'''
+		while self.lines:
+			yield self.lines.popleft()
+
+	def tail(self):
+		'''
+		The incomplete message received so far.
+		'''
+		return self.buffer.decode(self.encoding, 'replace')
+
+	def flush(self):
+		'''
+		Take the incomplete message as it is (e.g. the last message of
+		a response sent without a delimiter). If its delimiter arrives
+		later after all, it is dropped.
+		'''
+		tail = self.tail()
+
+		self.buffer = bytearray()
+		self.scanned = 0
+		self.skip = len(tail) > 0
+
+		return tail
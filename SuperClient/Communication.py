@@ -8,13 +8,61 @@
 	details such as en/decryption, multiparting and so on.
 '''
 
+import re
+import select
 import socket
-import struct
+import string
+import time
+from random import random
+
+from SuperClient.Codec import Keystream, ParityCodec, Frame, FrameCodec, ReassemblyBuffer, LineReader
+from SuperClient.Metrics import metrics
 
 RECV_BYTES = 4096 						# max bytes received from sockets
 MSG_DELIMETER = '\r\n' 					# separates messages
-STRUCT_FORMAT = '!8s??HH128s' 			# find details from UDPConnection.pack()
+MSG_END = '.' 							# ends a TCP response with keys
+TCP_TAIL_GRACE = 0.05 					# wait for a delimiter this long before taking a message without one (s)
+TCP_POOL_SIZE = 8 						# idle connections kept per server
+TCP_POOL_IDLE = 30.0 					# idle connections are closed after this (s)
+HEADER_FORMAT = '!8s??HH' 				# find details from UDPConnection.pack()
+CONTENT_BYTES = 128 					# size of the content field
+MULTIPART_AUTO = 0 						# multipart length: the largest the options allow
+STRUCT_FORMAT = HEADER_FORMAT + '128s' 	# the whole datagram
+DATAGRAM_SLOTS = 8 						# receive buffers per UDP connection
+MSG_RETRANSMIT = 'Send again' 			# asks the server to send the message again
+
+UDP_TIMEOUT = 1.0 						# initial retransmission timeout (s)
+UDP_MIN_TIMEOUT = 0.2 					# lower bound for the timeout (s)
+UDP_MAX_TIMEOUT = 8.0 					# upper bound for the backed off timeout (s)
+UDP_RETRIES = 5 						# retransmission requests per message
+TIMEOUT_JITTER = 0.1 					# random extra wait, fraction of the timeout
+REORDER_HOLD = 0.005 					# a multipart message is held this long for late fragments (s)...
+REORDER_RTT = 0.5 						# ...or this fraction of the round-trip time if it's shorter
+
 ENCODING = 'utf-8' 						# character encoding
+RETRANSMIT_BYTES = MSG_RETRANSMIT.encode(ENCODING) 	# MSG_RETRANSMIT as sent over UDP
+TEXT_BYTES = (string.ascii_letters + string.digits + " .,!?'-").encode(ENCODING) 	# what ordinary text is mostly made of
+TEXT_MIN_RATIO = 0.9 					# decrypted messages with fewer TEXT_BYTES than this are garbage
+TEXT_MIXED = re.compile(rb'[a-z][0-9]|[0-9][a-z]') 	# digits in lowercase words don't count as text
+KEYSYNC_WINDOW = 4 						# keys looked ahead for when the keys have slipped (key sync)
+
+
+class RetransmissionError(Exception):
+	'''
+	Raised by UDPConnection.receive() when a message couldn't be received
+	even after asking for it again as many times as allowed.
+	'''
+	pass
+
+
+class KeystreamError(RetransmissionError):
+	'''
+	Raised by UDPConnection.receive() when a decrypted message turns out to
+	be garbage: the keystreams are out of step and every message from now on
+	would be garbage too.
+	'''
+	pass
+
 
 class TCPConnection:
 	'''
@@ -26,8 +74,16 @@ class TCPConnection:
 	addr = ''
 	port = 0
 	sock = None
+	lines = None 		# LineReader, splits the stream into messages
+	reused = False 		# taken from a TCPPool, used before
 	log = None
 
+	# metrics (see Metrics.py), shared by all connections
+	m_opened = metrics.counter('tcp_connections_opened', "TCP connections opened")
+	m_connect = metrics.histogram('tcp_connect_seconds', "Time to open a TCP connection")
+	m_bytes_sent = metrics.counter('tcp_bytes_sent', "Bytes sent over TCP")
+	m_bytes_received = metrics.counter('tcp_bytes_received', "Bytes received over TCP")
+
 	def __init__(self, addr, port, log):
 		'''
 		Constructs an istance of the class and creates a TCP socket.
@@ -37,6 +93,7 @@ class TCPConnection:
 		self.log = log
 
 		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.lines = LineReader(MSG_DELIMETER, ENCODING)
 
 		return
 
@@ -44,7 +101,12 @@ class TCPConnection:
 		'''
 		Simply connects the socket to the configured server.
 		'''
+		started = time.monotonic()
 		self.sock.connect((self.addr, self.port))
+
+		self.m_connect.record(time.monotonic() - started)
+		self.m_opened.inc()
+
 		return
 
 	def send(self, messages):
@@ -57,22 +119,67 @@ class TCPConnection:
 
 		# send the request
 		self.sock.sendall(request)
+		self.m_bytes_sent.inc(len(request))
 
 		
-	def receive(self):
+	def messages(self, grace=0.0, timeout=None):
 		'''
-		Receive a TCP message and split it into pieces by MSG_DELIMETER.
-		Returns a list of messages.
+		Generator that yields the received messages one by one as they
+		arrive. Ends when the server closes the connection. If @timeout is
+		given, socket.timeout is raised when nothing arrives within @timeout
+		seconds.
+
+		Servers don't necessarily end the last message of a response with
+		a delimiter: a lone MSG_END is always taken as a complete message.
+		If @grace is given, any other unfinished message is taken as it is
+		if nothing more arrives within @grace seconds.
 		'''
-		response = self.sock.recv(RECV_BYTES)
+		while True:
+			yield from self.lines.messages()
 
-		# split the response into individual messages
-		messages = response.decode(ENCODING).split(MSG_DELIMETER)
+			tail = self.lines.tail()
 
-		self.log.received_tcp(messages)
+			if tail == MSG_END:
+				yield self.lines.flush()
+				continue
+
+			self.sock.settimeout(grace if grace and tail else timeout)
+
+			try:
+				response = self.sock.recv(RECV_BYTES)
+			except socket.timeout:
+				if not (grace and tail): raise
+				yield self.lines.flush()
+				continue
+			finally:
+				self.sock.settimeout(None)
+
+			# connection closed, whatever is left is the last message
+			if not response:
+				if tail: yield self.lines.flush()
+				return
+
+			self.m_bytes_received.inc(len(response))
+			self.log.received_tcp(self.lines.feed(response))
+
+	def healthy(self):
+		'''
+		Tells if an idle connection can still be used: the server hasn't
+		closed it and there's nothing unexpected waiting to be read.
+		'''
+		self.sock.setblocking(False)
+
+		try:
+			data = self.sock.recv(1, socket.MSG_PEEK)
+		except BlockingIOError:
+			return True
+		except OSError:
+			return False
+		finally:
+			self.sock.setblocking(True)
 
-		# return a list of messages (strings)
-		return messages
+		# closed (b'') or unexpected data
+		return False
 
 	def close(self):
 		'''
@@ -82,6 +189,209 @@ class TCPConnection:
 		return
 
 
+class TCPPool:
+	'''
+	Keeps TCP connections open between sessions so that the next session
+	doesn't have to wait for the handshake (and the teardown) of a new one.
+	Only works with servers that accept more than one HELLO per connection;
+	a connection the server has closed is noticed by the health check and
+	replaced with a new one.
+
+	Idle connections are kept per server, the most recently used is reused
+	first so that the rest can time out when the load goes down.
+	'''
+	size = TCP_POOL_SIZE 			# idle connections kept per server
+	idle_timeout = TCP_POOL_IDLE 	# idle connections older than this are closed (s)
+	idle = {} 						# (addr, port) --> list of (connection, released at)
+
+	# statistics
+	hits = 0 						# connections reused
+	misses = 0 						# new connections opened
+	discarded = 0 					# idle connections that were closed
+
+	def __init__(self, size=TCP_POOL_SIZE, idle_timeout=TCP_POOL_IDLE):
+		self.size = size
+		self.idle_timeout = idle_timeout
+		self.idle = {}
+		self.hits = 0
+		self.misses = 0
+		self.discarded = 0
+
+	def acquire(self, addr, port, log, fresh=False):
+		'''
+		Returns a connected TCPConnection: a healthy idle one if there is one
+		(and @fresh is not set), otherwise a new one. The @reused attribute of
+		the connection tells which. Raises the exceptions of connectToServer().
+		'''
+		tcp = None if fresh else self.reuse(addr, port, log)
+
+		if tcp is None:
+			tcp = TCPConnection(addr, port, log)
+			tcp.connectToServer()
+			self.misses += 1
+
+		return tcp
+
+	def reuse(self, addr, port, log):
+		'''
+		Take a healthy idle connection to the server, if there is one.
+		'''
+		idle = self.idle.get((addr, port), [])
+		now = time.monotonic()
+
+		while idle:
+			tcp, released = idle.pop()
+
+			if now - released > self.idle_timeout or not tcp.healthy():
+				self.discard(tcp)
+				continue
+
+			self.hits += 1
+			tcp.log = log
+			tcp.reused = True
+			return tcp
+
+		return None
+
+	def release(self, tcp):
+		'''
+		Give a connection back after a complete response. It's closed instead
+		if the pool is full or if it has unread data (a confused server).
+		'''
+		idle = self.idle.setdefault((tcp.addr, tcp.port), [])
+		self.prune(idle)
+
+		if len(idle) >= self.size or tcp.lines.lines or tcp.lines.tail():
+			self.discard(tcp)
+			return
+
+		idle.append((tcp, time.monotonic()))
+		return
+
+	def warm(self, addr, port, log, count=None):
+		'''
+		Open connections in advance so that they're ready for the next
+		sessions. Fills the pool of the server (up to @count connections).
+		'''
+		idle = self.idle.setdefault((addr, port), [])
+		count = self.size if count is None else min(count, self.size)
+
+		while len(idle) < count:
+			tcp = TCPConnection(addr, port, log)
+			tcp.connectToServer()
+			idle.append((tcp, time.monotonic()))
+
+		return
+
+	def prune(self, idle):
+		'''
+		Close the connections of @idle that have been idle for too long.
+		'''
+		now = time.monotonic()
+
+		for tcp, released in [c for c in idle if now - c[1] > self.idle_timeout]:
+			idle.remove((tcp, released))
+			self.discard(tcp)
+
+		return
+
+	def discard(self, tcp):
+		tcp.close()
+		self.discarded += 1
+
+	def close(self):
+		'''
+		Close all the idle connections.
+		'''
+		for idle in self.idle.values():
+			for tcp, released in idle:
+				tcp.close()
+
+		self.idle = {}
+		return
+
+
+class DatagramPool:
+	'''
+	A ring of preallocated receive buffers. Datagrams are received straight
+	into a slot with recvfrom_into() so no new bytes object is created per
+	datagram. A slot is reused after @count other datagrams, so data pointing
+	to it (memoryviews) must be consumed or copied before that.
+	'''
+	slots = []
+	current = 0
+
+	def __init__(self, count, size):
+		'''
+		Allocate @count slots of @size bytes each. The slots are stored as
+		memoryviews so they can be sliced without copying.
+		'''
+		self.slots = [memoryview(bytearray(size)) for i in range(count)]
+		self.current = 0
+
+	def acquire(self):
+		'''
+		Return the next free slot (the oldest one).
+		'''
+		slot = self.slots[self.current]
+		self.current = (self.current + 1) % len(self.slots)
+
+		return slot
+
+
+class RTTEstimator:
+	'''
+	Estimates the round-trip time to the server and derives a retransmission
+	timeout (RTO) from it. This is the Jacobson/Karels algorithm, like TCP
+	uses (RFC 6298): a smoothed RTT and its mean deviation.
+	'''
+	ALPHA = 1/8 		# gain of the smoothed RTT
+	BETA = 1/4 			# gain of the RTT variation
+	K = 4 				# how many variations are added to the RTO
+
+	srtt = None 		# smoothed round-trip time
+	rttvar = 0.0 		# round-trip time variation
+	rto = UDP_TIMEOUT 	# current timeout
+	min_rto = UDP_MIN_TIMEOUT
+	max_rto = UDP_MAX_TIMEOUT
+
+	def __init__(self, rto=UDP_TIMEOUT, min_rto=UDP_MIN_TIMEOUT, max_rto=UDP_MAX_TIMEOUT):
+		self.srtt = None
+		self.rttvar = 0.0
+		self.rto = rto
+		self.min_rto = min_rto
+		self.max_rto = max_rto
+
+	def sample(self, rtt):
+		'''
+		Update the estimate with a measured round-trip time (seconds).
+		'''
+		if self.srtt is None:
+			# first measurement
+			self.srtt = rtt
+			self.rttvar = rtt / 2
+		else:
+			self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+			self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+
+		self.rto = min(max(self.srtt + self.K * self.rttvar, self.min_rto), self.max_rto)
+		return
+
+	def backoff(self):
+		'''
+		A timeout happened: double the timeout (up to the maximum).
+		'''
+		self.rto = min(self.rto * 2, self.max_rto)
+		return
+
+	def timeout(self):
+		'''
+		The time to wait for a response. A bit of random jitter is
+		added so that many clients don't retry at the same moment.
+		'''
+		return self.rto * (1 + TIMEOUT_JITTER * random())
+
+
 class UDPConnection:
 	'''
 	This class is first of all an abstraction layer for sockets (the client doesn't
@@ -89,6 +399,11 @@ class UDPConnection:
 	what options were set. These modes include encryption, multipart messages
 	and parity bits (error detection).
 	Communicates with a server using UDP with some toppings.
+
+	Messages are bytes all the way from send() to the socket and from the
+	socket to receive(): encrypting, parity and packing never convert them to
+	strings and back, and each character takes exactly one byte of the
+	content field. Whoever uses this encodes and decodes the text.
 	'''
 	cid = ''
 	addr = ''
@@ -100,9 +415,54 @@ class UDPConnection:
 	opt_enc = False 		# encryption
 	opt_mul = False 		# multipart messages
 	opt_par = False 		# parity bit
-	enc_keys_de = [] 		# encryption keyset (for decrypting)
-	enc_keys_en = [] 		# encryption keyset (for encrypting)
+	opt_sync = False 		# keep the keys in step when datagrams are lost, see enableKeySync()
+	enc_keys_de = None 		# encryption keyset (for decrypting), a Keystream
+	enc_keys_en = None 		# encryption keyset (for encrypting), a Keystream
 	mul_len = 64 			# multipart maximum message length
+	mul_auto = False 		# pick @mul_len based on the options
+	opt_tmo = False 		# receive timeouts
+	retries = UDP_RETRIES 	# retransmission requests per message
+	rtt = None 				# round-trip time estimator (for timeouts)
+	sent_at = 0.0 			# when the latest message was sent
+	tx_message = b'' 		# latest message sent, see resend()
+	tx_last = [] 			# ...and its datagrams (bytes) with key sync
+
+	rx_hold = True 			# hold multipart messages for late fragments, see holdTime()
+
+	# state of the message being received
+	rx_retries = 0
+	rx_measure = True
+	rx_asked = False 		# has the message been asked again
+	rx_garbled = 0 			# length of the longest garbled copy of the message (key sync)
+	rx_message = b''
+	rx_ack = True
+	rx_eom = False
+
+	# results of handleDatagram()
+	RX_WAIT = 0
+	RX_RETRY = 1
+	RX_DONE = 2
+	RX_HOLD = 3
+	RX_RESEND = 4
+
+	parity = None 			# parity lookup tables, see Codec.py
+	frames = None 			# datagram packer with a reusable buffer
+	rx_frame = None 		# received datagrams are unpacked into this
+	rx_pool = None 			# received datagrams are stored in here
+	rx_buffer = None 		# fragments are collected in here
+
+	# metrics (see Metrics.py), shared by all connections
+	m_sent = metrics.counter('udp_datagrams_sent', "UDP datagrams sent")
+	m_received = metrics.counter('udp_datagrams_received', "UDP datagrams received")
+	m_bytes_sent = metrics.counter('udp_bytes_sent', "Bytes sent over UDP")
+	m_bytes_received = metrics.counter('udp_bytes_received', "Bytes received over UDP")
+	m_timeouts = metrics.counter('udp_timeouts', "Responses that didn't arrive in time (asked again)")
+	m_invalid = metrics.counter('udp_invalid_messages', "Invalid messages (asked again)")
+	m_parity = metrics.counter('udp_parity_failures', "Fragments that failed the parity check")
+	m_duplicates = metrics.counter('udp_duplicate_fragments', "Duplicate fragments dropped")
+	m_no_keys = metrics.counter('udp_keys_exhausted', "Fragments sent or received without a key")
+	m_malformed = metrics.counter('udp_malformed_datagrams', "Datagrams of the wrong size dropped")
+	m_non_ascii = metrics.counter('udp_non_ascii_bytes', "Bytes replaced before adding parity bits")
 
 	def __init__(self, cid, addr, port, log):
 		'''
@@ -112,17 +472,152 @@ class UDPConnection:
 		self.addr = addr
 		self.port = port
 		self.log = log
+		self.parity = ParityCodec()
+		self.frames = FrameCodec(HEADER_FORMAT, CONTENT_BYTES, cid.encode(ENCODING))
+		self.rx_frame = Frame()
+		self.rx_pool = self.createPool()
+		self.rx_buffer = ReassemblyBuffer()
+		self.tx_message = b''
+		self.tx_last = []
 
 		# create the socket and return
-		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock = self.createSocket()
 
 		return
 
+	def createSocket(self):
+		'''
+		Create the UDP socket. Other transports override this.
+		'''
+		return socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+	def createPool(self):
+		'''
+		Create the buffers that datagrams are received into. Other
+		transports that are handed the datagrams override this.
+		'''
+		# the slots are larger than a datagram so that a datagram too
+		# large doesn't fit in exactly and pass as a valid one
+		return DatagramPool(DATAGRAM_SLOTS, RECV_BYTES)
+
 
 	def send(self, message, ack=True):
 		'''
-		Send a UDP message to the configured server. Takes in a list of messages
-		and manipulates them according to the options, before sending.
+		Send a UDP message (bytes) to the configured server. The message is
+		manipulated according to the options before sending. Messages with
+		@ack are kept for resend().
+		'''
+		if ack: self.tx_message = message
+
+		if ack and self.opt_sync:
+			self.tx_last = [bytes(datagram) for datagram in self.datagrams(message)]
+			self.resend()
+			return
+
+		for datagram in self.datagrams(message, ack):
+			self.sock.sendto(datagram, (self.addr, self.port))
+
+		return
+
+	def resend(self):
+		'''
+		Send the latest message again. It's encrypted with new keys like any
+		message, but with key sync it's sent exactly as it was, see datagrams().
+		'''
+		if not self.opt_sync:
+			self.send(self.tx_message)
+			return
+
+		for datagram in self.tx_last:
+			self.sock.sendto(datagram, (self.addr, self.port))
+
+		return
+
+
+	def receive(self):
+		'''
+		Receive from server using UDP. Takes care of all the details:
+		de/encryption, validity checks, multiparts...
+		Returns a tuple containing the message (bytes) and the EOM flag.
+
+		TODO: what do we do with sender_addr? check that it's the same?
+
+		If timeouts are enabled, the message is asked again when nothing arrives
+		in time. Both timeouts and invalid messages use up the retry budget, after
+		which RetransmissionError is raised.
+		'''
+		self.beginReceive()
+		status = self.RX_WAIT
+
+		# reception loop
+		while True:
+
+			# receive a message (possibly a fragment if multipart)
+			# directly into a preallocated buffer
+			slot = self.rx_pool.acquire()
+
+			# the message looks complete, a late fragment may still come
+			# (select() since socket timeouts are rounded up to milliseconds)
+			if status == self.RX_HOLD and not select.select([self.sock], [], [], self.holdTime())[0]:
+				# nothing was left behind --> take the message
+				status = self.acceptMessage()
+
+			else:
+				if self.opt_tmo:
+					self.sock.settimeout(self.rtt.timeout())
+
+				try:
+					nbytes, sender_addr = self.sock.recvfrom_into(slot)
+				except socket.timeout:
+					# nothing arrived in time --> ask again
+					self.handleTimeout()
+					self.send(RETRANSMIT_BYTES, ack=False)
+					continue
+
+				status = self.handleDatagram(slot[:nbytes])
+
+			# invalid data --> ask for retransmission --> restart
+			if status == self.RX_RETRY:
+				self.send(RETRANSMIT_BYTES, ack=False)
+
+			# the server asks for our message again
+			elif status == self.RX_RESEND:
+				self.resend()
+
+			# message received, go return it
+			elif status == self.RX_DONE:
+				break
+
+		return (self.rx_message, self.rx_eom)
+
+
+	def close(self):
+		'''
+		Simply close the socket.
+		'''
+		self.sock.close()
+		return
+
+
+	#--------------------------------------------------
+	# 				 PROTOCOL METHODS
+	#--------------------------------------------------
+	# These do the actual work of send() and receive()
+	# without touching the socket, so that they can be
+	# reused with other transports (AsyncCommunication).
+	# -------------------------------------------------
+
+	def datagrams(self, message, ack=True):
+		'''
+		Manipulate a message according to the options and yield it as packed
+		datagrams, ready to be sent. Each datagram must be sent before asking
+		for the next one because they share the same buffer.
+
+		Each fragment uses a key, so a lost datagram puts the keystreams out
+		of step. With key sync (see enableKeySync()) a key is used only by
+		a fragment that gets through sooner or later: requests to send again
+		(no @ack) may be lost for good, so they are not encrypted, and a
+		message that is asked again is resent as it is (see resend()).
 		'''
 
 		# split the message in pieces if the option is set
@@ -131,12 +626,13 @@ class UDPConnection:
 		
 		remaining = len(message)
 
-		# send the partitioned or complete messages
+		# yield the partitioned or complete messages
 		for k,m in enumerate(msg_parts):
 
 			# encrypt if configured so
-			if self.opt_enc:
+			if self.opt_enc and (ack or not self.opt_sync):
 				if len(self.enc_keys_en) == 0:
+					self.m_no_keys.inc()
 					self.log.no_encryption_keys()
 				else:
 					m = self.__encrypt(m)
@@ -147,74 +643,269 @@ class UDPConnection:
 			remaining -= msg_lens[k]
 
 			# Struct: [CID, ACK, EOM, REMAIN, LEN, CONTENT]
-			msg_struct = self.pack(self.cid, ack, False, remaining, msg_lens[k], m)
-			self.sock.sendto(msg_struct, (self.addr, self.port))
+			yield self.pack(self.cid, ack, False, remaining, msg_lens[k], m)
+
+			self.m_sent.inc()
+			self.m_bytes_sent.inc(self.frames.size)
 			
 			# log the event
 			self.log.sent(ack, remaining, msg_lens[k], m, 'UDP')
-		
-		return 
 
+		# the round-trip time is measured from here
+		self.sent_at = time.monotonic()
 
-	def receive(self):
+		return
+
+	def beginReceive(self):
 		'''
-		Receive from server using UDP. Takes care of all the details:
-		de/encryption, validity checks, multiparts...
+		Get ready to receive a new message.
+		'''
+		self.rx_retries = 0
+		self.rx_measure = True 		# Karn: don't measure RTT of retransmitted messages
+		self.rx_asked = False
+		self.rx_garbled = 0
+		self.rx_message = b''
+		self.rx_eom = False
 
-		TODO: what do we do with sender_addr? check that it's the same?
+		return
+
+	def handleTimeout(self):
 		'''
+		Nothing arrived in time: wait longer next time. The caller must ask
+		for the message again. Raises RetransmissionError if out of retries.
+		'''
+		self.rx_retries += 1
+		if self.rx_retries > self.retries:
+			raise RetransmissionError("No response after {} retries".format(self.retries))
 
-		message = ''
-		all_valid = True
+		self.rtt.backoff()
+		self.m_timeouts.inc()
+		self.log.timeout(self.rx_retries, self.rtt.rto)
 
-		# reception loop
-		while True:
+		# any fragments received so far will be sent again
+		if not self.rx_eom: self.spendKeys(len(self.rx_buffer.fragments))
+		self.rx_buffer.reset()
+		self.rx_measure = False
+		self.rx_asked = True
 
-			# receive and unpack a message (possibly a fragment if multipart)
-			msg, sender_addr = self.sock.recvfrom(RECV_BYTES)
-			cid, ack, eom, remain, length, content = self.unpack(msg)
+		return
 
-			# last message does not have a parity bit
-			if self.opt_par and not eom:
-				content, valid = self.__checkParity(content, length)
-				self.log.received_udp(content)
-				if not valid: all_valid = False
+	def holdTime(self):
+		'''
+		How long a multipart message that looks complete is held before
+		taking it: its first fragment may have fallen behind the others
+		(see ReassemblyBuffer). A fraction of the round-trip time is
+		enough, fragments are sent back to back.
+		'''
+		if self.rtt is None or self.rtt.srtt is None:
+			return REORDER_HOLD
 
-			# last message is not encrypted (eom)
-			if self.opt_enc and not eom:
-				if len(self.enc_keys_de) == 0:
-					self.log.no_decryption_keys()
-				else:
-					content = self.__decrypt(content)
-			
-			# invalid data --> ask for retransmission --> restart
-			# we still have to wait 'til the end of multipart (remain = 0)
-			if not all_valid and remain == 0:
-				self.log.invalid_msg()
-				self.send('Send again', ack=False)
-				
-				# basically start the receive function over
-				message = ''
-				all_valid = True
-				continue
+		return min(self.rtt.srtt * REORDER_RTT, REORDER_HOLD)
 
-			else:
-				# append the fragment to the message
-				message += content
+	def handleDatagram(self, packet):
+		'''
+		Handle a received datagram. Returns one of:
+			RX_WAIT 	more fragments are needed
+			RX_HOLD 	the message looks complete, but a late fragment may still
+						come: wait holdTime() for one, then call acceptMessage()
+			RX_RETRY 	the message was invalid, the caller must ask it again
+			RX_RESEND 	the peer asked for the latest message again, see resend()
+			RX_DONE 	the message is complete, see @self.rx_message & @self.rx_eom
+		Raises RetransmissionError if an invalid message is out of retries.
+		Datagrams of the wrong size are dropped.
+
+		Fragments may arrive in any order, they are put in their place by the
+		ReassemblyBuffer. Decryption is done only when the message is complete
+		because the keys must be used in the order the fragments were sent.
+		Every fragment received uses up a key, whether it's taken or not,
+		like every fragment sent does at the other end. With key sync, only
+		the messages that are taken use keys (see datagrams()).
+		'''
 
-			# message received, go return it
-			if remain == 0: break
+		self.m_received.inc()
+		self.m_bytes_received.inc(len(packet))
 
-		return (message, eom)
+		# not one of ours (or truncated), there's nothing to recover
+		if len(packet) != self.frames.size:
+			self.m_malformed.inc()
+			self.log.malformed_datagram(len(packet))
+			return self.pending()
 
+		# the first datagram of a response gives us a round-trip time
+		if self.opt_tmo and self.rx_measure:
+			self.rtt.sample(time.monotonic() - self.sent_at)
+			self.rx_measure = False
 
-	def close(self):
+		frame = self.unpack(packet)
+		valid = True
+
+		# The content is still in the receive buffer, which will be reused:
+		# it's copied out exactly once. Removing the parity bits makes the
+		# copy anyway, otherwise it's done here. Last message does not
+		# have a parity bit.
+		if self.opt_par and not frame.eom:
+			content, valid = self.__checkParity(frame.content, frame.length)
+			self.log.received_udp(content)
+		else:
+			content = bytes(frame.content)
+
+		# put the fragment in its place, drop it if we already have it
+		if not self.rx_buffer.add(frame.remain, frame.length, content, valid):
+			self.m_duplicates.inc()
+			self.log.duplicate_fragment(frame.remain, frame.length)
+			if not frame.eom: self.spendKeys(1)
+			return self.pending()
+
+		self.rx_ack = frame.ack
+		self.rx_eom = frame.eom
+
+		# wait for the rest of the fragments
+		if not self.rx_buffer.complete():
+			return self.RX_WAIT
+
+		if self.rx_hold and self.opt_mul:
+			return self.RX_HOLD
+
+		return self.acceptMessage()
+
+	def pending(self):
 		'''
-		Simply close the socket.
+		The status after a datagram that didn't add anything to the message.
 		'''
-		self.sock.close()
+		if self.rx_hold and self.opt_mul and self.rx_buffer.complete():
+			return self.RX_HOLD
+
+		return self.RX_WAIT
+
+	def acceptMessage(self):
+		'''
+		Take the message once all of its fragments have arrived. Returns
+		RX_DONE, RX_RESEND or RX_RETRY, see handleDatagram(). Raises
+		KeystreamError if the message doesn't decrypt to text.
+		'''
+		fragments = self.rx_buffer.ordered()
+
+		# last message (eom) is not encrypted,
+		# with key sync neither are requests to send again
+		encrypted = self.opt_enc and not self.rx_eom and (self.rx_ack or not self.opt_sync)
+		cursor = self.enc_keys_de.cursor if encrypted else 0
+
+		# an invalid message uses up its keys too, unless with key sync
+		if encrypted and not self.opt_sync:
+			fragments = self.decryptFragments(fragments)
+
+		# invalid data --> retransmission is needed
+		if not self.rx_buffer.valid:
+			return self.rejectMessage()
+
+		if encrypted and self.opt_sync:
+			fragments = self.decryptFragments(fragments)
+
+		message = b''.join(fragments)
+
+		# with the wrong keys, the text turns into garbage
+		if encrypted and not self.looksLikeText(message):
+			self.log.keystream_lost()
+			if not self.opt_sync:
+				raise KeystreamError("The decrypted message is not text, the keys are out of step")
+
+			# probably the first fragment is missing (see ReassemblyBuffer),
+			# ask again: the copy sent again will use the same keys
+			self.enc_keys_de.cursor = cursor
+			if len(message) > self.rx_garbled:
+				self.rx_garbled = len(message)
+				return self.rejectMessage()
+
+			# the whole message has arrived garbled before: an earlier
+			# message (a few characters may decrypt to text by chance)
+			# was taken with too few keys
+			message = self.resyncKeys(len(fragments))
+			if not message:
+				return self.rejectMessage()
+
+		# message received
+		# copies of it may still come if it was asked again
+		self.rx_buffer.done(self.rx_asked)
+		self.rx_message = message
+
+		if not self.rx_ack and self.rx_message == RETRANSMIT_BYTES:
+			return self.RX_RESEND
+
+		return self.RX_DONE
+
+	def rejectMessage(self):
+		'''
+		The message was invalid: the caller must ask it again. Returns
+		RX_RETRY, raises RetransmissionError if out of retries.
+		'''
+		self.rx_retries += 1
+		if self.rx_retries > self.retries:
+			raise RetransmissionError("Invalid message after {} retries".format(self.retries))
+
+		self.m_invalid.inc()
+		self.log.invalid_msg()
+		self.rx_buffer.reset()
+		self.rx_asked = True
+
+		return self.RX_RETRY
+
+	def decryptFragments(self, fragments):
+		'''
+		Decrypt the fragments of a message (in message order), one key each.
+		'''
+		for k,fragment in enumerate(fragments):
+			if len(self.enc_keys_de) == 0:
+				self.m_no_keys.inc()
+				self.log.no_decryption_keys()
+			else:
+				fragments[k] = self.__decrypt(fragment)
+
+		return fragments
+
+	def spendKeys(self, count):
+		'''
+		Fragments that were received but not taken use up their keys
+		anyway, unless with key sync (see handleDatagram()).
+		'''
+		if self.opt_enc and not self.opt_sync:
+			self.enc_keys_de.skip(count)
+
 		return
 
+	def resyncKeys(self, count):
+		'''
+		Look for the keys of the message (@count fragments) up to
+		KEYSYNC_WINDOW keys ahead of the cursor. Returns the decrypted
+		message and leaves the cursor after its keys, or returns b'' and
+		leaves the cursor as it was.
+		'''
+		cursor = self.enc_keys_de.cursor
+		fragments = self.rx_buffer.ordered()
+
+		for skipped in range(1, KEYSYNC_WINDOW + 1):
+			self.enc_keys_de.cursor = cursor
+			self.enc_keys_de.skip(skipped)
+			if len(self.enc_keys_de) < count: break
+
+			message = b''.join(self.__decrypt(fragment) for fragment in fragments)
+			if self.looksLikeText(message):
+				self.log.keys_resynced(skipped)
+				return message
+
+		self.enc_keys_de.cursor = cursor
+		return b''
+
+	def looksLikeText(self, message):
+		'''
+		Tells if a decrypted message looks like text: mostly letters, digits,
+		spaces and common punctuation. Decrypted with the wrong keys, about
+		a quarter of the characters turn into other symbols and many letters
+		into digits in the middle of words.
+		'''
+		others = len(message.translate(None, TEXT_BYTES)) + len(TEXT_MIXED.findall(message))
+		return others <= len(message) * (1 - TEXT_MIN_RATIO)
+
+
 
 	#--------------------------------------------------
 	# 				  OPTION METHODS
@@ -231,20 +922,46 @@ class UDPConnection:
 		'''
 		self.opt_enc = True
 
-		# keysets are reversed so the first key is in the end of the
-		# list – we can use list.pop() when using the keys
-		self.enc_keys_en = keys_en[::-1]
-		self.enc_keys_de = keys_de[::-1]
+		# the keys are converted to bytes here, once and for all, and
+		# stored one after another, Keystream.xor() uses them in order
+		self.enc_keys_en = Keystream(keys_en)
+		self.enc_keys_de = Keystream(keys_de)
+
+		if self.mul_auto: self.mul_len = self.maxFragment()
+
+		return
 
+	def enableKeySync(self):
+		'''
+		Keep the keystreams in step when datagrams are lost: a key is only
+		used by a message that gets through (see datagrams()). This is an
+		extension of the protocol, both ends must have agreed on it (see
+		Client.buildRequest()).
+		'''
+		self.opt_sync = True
 		return
 
-	def enableMultipart(self, length):
+	def enableMultipart(self, length=MULTIPART_AUTO):
 		'''
 		Enables multipart messages.
-		Also sets a length for multipart message content.
+		Also sets a length for multipart message content. With MULTIPART_AUTO,
+		the length is the largest one the other options allow.
 		'''
 		self.opt_mul = True
-		self.mul_len = length
+		self.mul_auto = (length == MULTIPART_AUTO)
+		self.mul_len = self.maxFragment() if self.mul_auto else length
+
+		return
+
+	def enableTimeouts(self, timeout=UDP_TIMEOUT, retries=UDP_RETRIES):
+		'''
+		Enables receive timeouts. @timeout is the initial timeout, after the
+		first response it's based on the measured round-trip time.
+		@retries tells how many times a message is asked again before giving up.
+		'''
+		self.opt_tmo = True
+		self.rtt = RTTEstimator(timeout)
+		self.retries = retries
 
 		return
 
@@ -273,28 +990,29 @@ class UDPConnection:
 		There are two reasons why these are still separately:
 		1) I think it's simply clearer this way,
 		2) Later it's easy to implement a new encryption algorithm.
-		'''
-
-		crypted = ''
-		key = self.enc_keys_en.pop()
-		for k,m in enumerate(message):
-			crypted += chr( ord(m) ^ ord(key[k]) )
 
-		return crypted
+		'''
+		return self.enc_keys_en.xor(message)
 
 	def __decrypt(self, crypted):
 		'''
 		Decrypt a crypted message. See __encrypt() for details.
 		'''
-		message = ''
-		key = self.enc_keys_de.pop()
-		for k,m in enumerate(crypted):
-			message += chr( ord(m) ^ ord(key[k]) )
-
-		return message
+		return self.enc_keys_de.xor(crypted)
 
 	# Partition
 
+	def maxFragment(self):
+		'''
+		The longest fragment that fits in a datagram with the current options.
+		Each character takes one byte whether it has a parity bit or not, but
+		an encrypted fragment can't be longer than a key.
+		'''
+		if self.opt_enc and self.enc_keys_en.key_len:
+			return min(CONTENT_BYTES, self.enc_keys_en.key_len)
+
+		return CONTENT_BYTES
+
 	def __partition(self, message):
 		'''
 		Partition given message usinf @self.mul_len option.
@@ -317,39 +1035,29 @@ class UDPConnection:
 
 	def __addParity(self, message):
 		'''
-		Adds a parity bits to each character of the message.
+		Adds a parity bits to each character of the message. Bytes that
+		don't fit in 7 bits are replaced (and counted).
 		'''
-		msg_par = ''
-		for c in message:
-			c = (ord(c) << 1)
-			c += self.get_parity(c)
-			msg_par += chr(c)
+		count = self.parity.nonAscii(message)
+		if count:
+			self.m_non_ascii.inc(count)
+			self.log.non_ascii(count)
 
-		return msg_par
+		return self.parity.encode(message)
 
 	def __checkParity(self, msg_par, length):
 		'''
 		Checks parity from message and returns a tuple containing the message
 		without parity and a boolean that tells if the message was valid.
 		'''
+		message, errors = self.parity.decode(msg_par)
 
-		message = ''
-		valid = True
-
-		for c in msg_par:
-			c = ord(c) 							# get numeric value of the character
-			received_parity = c & 1 			# read the parity bit of a character
-			c >>= 1 							# right shift by 1 bit
-			actual_parity = self.get_parity(c) # calc the parity of the shifted character
-			
-			# compare to perceived parity bit
-			if received_parity != actual_parity:
-				valid = False
-			
-			# append the 'original' character to the message
-			message += chr(c)
+		# tell exactly which characters were broken
+		if errors:
+			self.m_parity.inc()
+			self.log.parity_errors(errors, length)
 
-		return (message, valid)
+		return (message, len(errors) == 0)
 
 	# Pack & Unpack
 
@@ -365,39 +1073,33 @@ class UDPConnection:
 			remain: 	unsigned short 	H
 			length: 	unsigned short 	H
 			content: 	char[128] 		128s
+
+		The struct is precompiled and packed into a reusable buffer (see
+		FrameCodec), so the result is only valid until the next call.
 		'''
-		return struct.pack(
-			STRUCT_FORMAT,
-			cid.encode(ENCODING),
-			ack,
-			eom,
-			remain,
-			length,
-			content.encode(ENCODING)
-		)
+		if cid != self.cid:
+			self.frames.cid = cid.encode(ENCODING)
+			self.cid = cid
+
+		return self.frames.pack(ack, eom, remain, length, content)
 
 	def unpack(self, packet):
 		'''
 		Unpacks data from a struct packet.
 		Check the method above for formatting details.
+		Returns a Frame, which is reused between calls. The content is
+		a memoryview of @packet, see handleDatagram().
 		'''
-		cid, ack, eom, remain, length, content = struct.unpack(STRUCT_FORMAT, packet)
+		frame = self.frames.unpack(packet, self.rx_frame)
+
+		# strip the padding
+		frame.cid = frame.cid.decode(ENCODING, 'replace')
+		frame.content = frame.content[:frame.length]
 
-		# decode strings back from bytes format and return
-		# also strip empty bytes if present (padding)
-		return (
-			cid.decode(ENCODING)[:8],
-			ack,
-			eom,
-			remain,
-			length,
-			content.decode(ENCODING)[:length]
-		)
+		return frame
 
 	def get_parity(self, n):
 		'''
 		Get parity bit of given integer n.
 		'''
-		while n > 1:
-			n = (n >> 1) ^ (n & 1)
-		return n
+		return self.parity.parity(n)
@@ -0,0 +1,121 @@
+'''
+	SuperClient/Entropy.py
+	Random bytes for encryption keys. The bytes come from the operating
+	system's CSPRNG (os.urandom) in big blocks, so generating keysets for lots
+	of sessions costs one system call per block, and a background thread
+	refills the pool before it runs out so that keyset generation doesn't
+	have to wait for it during a handshake.
+'''
+
+import os
+import threading
+
+KEY_LEN = 64 							# characters in a key (hex, 4 bits each)
+POOL_BYTES = 64 * 1024 					# bytes drawn from os.urandom at a time
+POOL_LOW_WATER = 0.25 					# refill when less than this fraction is left
+
+
+class EntropyPool:
+	'''
+	A pool of random bytes. take() hands out bytes from the pool and wakes
+	up the refill thread when the pool gets low. If the pool runs out anyway
+	(a huge request), the bytes are drawn right away.
+
+	The pool is emptied in a forked child process so that the parent and
+	the child never hand out the same bytes.
+	'''
+	size = POOL_BYTES
+	low_water = 0
+	buffer = None 		# the random bytes
+	pid = 0 			# process the bytes were drawn in
+	lock = None
+	wakeup = None 		# tells the refill thread to refill
+	thread = None
+
+	def __init__(self, size=POOL_BYTES, low_water=POOL_LOW_WATER):
+		self.size = size
+		self.low_water = int(size * low_water)
+		self.buffer = bytearray()
+		self.pid = os.getpid()
+		self.lock = threading.Lock()
+		self.wakeup = threading.Event()
+		self.thread = None
+
+	def take(self, n):
+		'''
+		Returns @n random bytes.
+		'''
+		with self.lock:
+			# forked: the bytes (and the thread) belong to the parent
+			if self.pid != os.getpid():
+				self.buffer = bytearray()
+				self.pid = os.getpid()
+				self.thread = None
+
+			if len(self.buffer) < n:
+				self.buffer += os.urandom(max(n - len(self.buffer), self.size))
+
+			data = bytes(self.buffer[:n])
+			del self.buffer[:n]
+
+			if len(self.buffer) < self.low_water:
+				self.refillLater()
+
+		return data
+
+	def fill(self):
+		'''
+		Fill the pool up right away, e.g. before starting lots of sessions.
+		'''
+		self.take(0)
+
+		with self.lock:
+			if len(self.buffer) < self.size:
+				self.buffer += os.urandom(self.size - len(self.buffer))
+
+		return
+
+	def keyset(self, count, key_len=KEY_LEN):
+		'''
+		Returns a list of @count random hex keys, @key_len characters each.
+		All the keys are converted from one block of bytes at once.
+		'''
+		chars = self.take(count * ((key_len + 1) // 2)).hex()
+		step = len(chars) // count if count else 0
+
+		return [chars[k:k + key_len] for k in range(0, step * count, step)]
+
+	def refillLater(self):
+		'''
+		Wake up the refill thread (start it if needed). Called with the lock held.
+		'''
+		if self.thread is None:
+			self.thread = threading.Thread(target=self.refiller, daemon=True)
+			self.thread.start()
+
+		self.wakeup.set()
+
+	def refiller(self):
+		'''
+		The refill thread: fills the pool up whenever woken up.
+		The bytes are drawn without holding the lock.
+		'''
+		while True:
+			self.wakeup.wait()
+			self.wakeup.clear()
+
+			with self.lock:
+				missing = self.size - len(self.buffer)
+				pid = self.pid
+
+			if missing <= 0: continue
+
+			data = os.urandom(missing)
+
+			with self.lock:
+				if pid == self.pid:
+					self.buffer += data
+
+
+# shared by all the clients of a process
+entropy = EntropyPool()
@@ -0,0 +1,436 @@
+'''
+	SuperClient/LoadGen.py
+	Load generator for qualifying servers. Runs lots of sessions (AsyncClient)
+	against a server at the same time and reports how many sessions and
+	challenges per second the server handled and how long each phase of
+	a session took.
+
+	The sessions can also be split between worker processes (shards), each
+	running its own event loop, so that the load isn't limited to one core.
+'''
+
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from SuperClient.AsyncClient import AsyncClient
+from SuperClient.AsyncCommunication import AsyncTCPPool
+from SuperClient.Entropy import entropy
+from SuperClient.Log import Log
+from SuperClient.Metrics import Histogram, metrics
+from SuperClient.UI import UI, SilentUI
+from SuperClient.utils import parse_flags
+
+# phases of a session, in order
+PHASES = [
+	'tcp', 					# TCP connect + HELLO + keys
+	'hello', 				# UDP HELLO --> first challenge
+	'round_trip', 			# solution --> next challenge
+	'session', 				# the whole session
+]
+
+
+class LoadSession(AsyncClient):
+	'''
+	A single session run by the load generator. Doesn't print anything
+	but records how long each phase takes.
+	'''
+	phases = None 		# phase name --> Histogram (shared by all sessions)
+	challenges = 0
+	asked_at = 0.0 		# when the latest message was sent to the server
+	first = True
+
+	def __init__(self, address, port, opts, phases, pool=None):
+		super().__init__()
+
+		self.ui = SilentUI(False)
+		self.log = Log(self.ui, False)
+
+		self.srv_address = address
+		self.srv_tcp_port = port
+		self.setOptions(opts)
+
+		self.phases = phases
+		self.challenges = 0
+		self.first = True
+		self.tcp_pool = pool
+
+	async def run(self):
+		'''
+		Go through the pipeline like start() does, without the splash screen.
+		Returns True if the session was successful.
+		'''
+		started = time.monotonic()
+
+		if not await self.fetchCommParams():
+			return False
+
+		self.phases['tcp'].record(time.monotonic() - started)
+		self.asked_at = time.monotonic()
+
+		if not await self.UDPLoop():
+			return False
+
+		self.phases['session'].record(time.monotonic() - started)
+		return True
+
+	def answerChallenge(self, challenge, eom):
+		'''
+		Record the round-trip time before answering.
+		'''
+		self.phases['hello' if self.first else 'round_trip'].record(time.monotonic() - self.asked_at)
+		self.first = False
+
+		if not eom: self.challenges += 1
+
+		solution = super().answerChallenge(challenge, eom)
+		self.asked_at = time.monotonic()
+
+		return solution
+
+	def close(self):
+		'''
+		Close whatever connections are still open (after a failure).
+		'''
+		if self.udp is not None: self.udp.close()
+		if self.tcp is not None and self.tcp.writer is not None: self.tcp.close()
+
+		return
+
+
+class LoadGenerator:
+	# target
+	address = ''
+	port = 0
+	filename = ''
+
+	# load settings
+	sessions = 10 		# concurrent sessions
+	duration = 10.0 	# new sessions are started for this long (s)
+	ramp = 0.0 			# concurrent sessions are started gradually during this (s)
+	mix = ['emp'] 		# option strings, used in turns
+	workers = 1 		# processes, 0 = one per core
+	reuse = False 		# keep TCP connections open between sessions
+	metrics_path = '' 		# write the metrics here at the end (--metrics)...
+	metrics_interval = 0.0 	# ...and this often (s) meanwhile
+
+	# position of this shard's sessions among all sessions
+	first = 0
+	total = 0
+
+	# results
+	phases = {}
+	completed = 0
+	failed = 0
+	challenges = 0
+	errors = {} 		# error message --> count
+	elapsed = 0.0
+	tcp_opened = 0 		# TCP connections opened...
+	tcp_reused = 0 		# ...and reused (with --reuse)
+	metrics = None 		# metrics of a shard (its process' registry)
+
+	# error handling
+	error = False
+	error_msg = ''
+
+	ui = None
+
+	def __init__(self):
+		self.error = False
+		self.ui = UI(False)
+		self.reset()
+
+	def start(self, args):
+		'''
+		Validate the arguments, run the load and print a report.
+		'''
+		if not self.validateArgs(args):
+			return
+
+		self.ui.info("Running {} concurrent sessions in {} process(es) for {} s (ramp-up {} s, options {}{})...".format(
+			self.sessions, self.workers, self.duration, self.ramp, ','.join(self.mix), ', TCP reuse' if self.reuse else ''
+		))
+
+		if self.metrics_path and self.metrics_interval > 0:
+			metrics.exportEvery(self.metrics_path, self.metrics_interval)
+
+		if self.workers > 1:
+			self.runSharded()
+		else:
+			asyncio.run(self.run())
+
+		self.report()
+		self.writeMetrics()
+
+	def reset(self):
+		'''
+		Clear the results.
+		'''
+		self.phases = {phase: Histogram() for phase in PHASES}
+		self.completed = 0
+		self.failed = 0
+		self.challenges = 0
+		self.errors = {}
+		self.elapsed = 0.0
+		self.tcp_opened = 0
+		self.tcp_reused = 0
+
+	async def run(self):
+		'''
+		Run the concurrent sessions until the duration is over.
+		'''
+		pool = None
+		entropy.fill()
+
+		# one TCP connection per concurrent session, opened in advance
+		if self.reuse:
+			pool = AsyncTCPPool(size=self.sessions)
+			await pool.warm(self.address, self.port, Log(SilentUI(False), False))
+
+		started = time.monotonic()
+		deadline = started + self.duration
+
+		await asyncio.gather(*[self.worker(k, deadline, pool) for k in range(self.sessions)])
+
+		self.elapsed = time.monotonic() - started
+
+		if pool is not None:
+			self.tcp_opened = pool.misses + self.sessions
+			self.tcp_reused = pool.hits
+			pool.close()
+
+		return
+
+	def runSharded(self):
+		'''
+		Split the sessions evenly between worker processes, run them and
+		merge the results of the shards into this one.
+		'''
+		shards = []
+		first = 0
+
+		for k in range(self.workers):
+			sessions = self.sessions // self.workers + (1 if k < self.sessions % self.workers else 0)
+			if sessions == 0: break
+
+			shards.append((self.address, self.port, sessions, self.duration, self.ramp, self.mix, self.reuse, first, self.sessions))
+			first += sessions
+
+		with ProcessPoolExecutor(max_workers=len(shards)) as pool:
+			for shard in pool.map(run_shard, shards):
+				self.merge(shard)
+
+		return
+
+	def merge(self, other):
+		'''
+		Add the results of another (shard's) LoadGenerator to this one.
+		The shards run at the same time so the elapsed time is the longest one.
+		'''
+		for phase, hist in other.phases.items():
+			self.phases[phase].merge(hist)
+
+		self.completed += other.completed
+		self.failed += other.failed
+		self.challenges += other.challenges
+		self.tcp_opened += other.tcp_opened
+		self.tcp_reused += other.tcp_reused
+		self.elapsed = max(self.elapsed, other.elapsed)
+
+		if other.metrics is not None:
+			metrics.merge(other.metrics)
+
+		for msg, count in other.errors.items():
+			self.errors[msg] = self.errors.get(msg, 0) + count
+
+		return
+
+	async def worker(self, index, deadline, pool=None):
+		'''
+		Runs sessions one after another until @deadline. The sessions
+		take their TCP connections from @pool, if given.
+		'''
+
+		# index among all the sessions (of all shards)
+		n = self.first + index
+		total = self.total or self.sessions
+
+		# ramp-up: start the workers gradually
+		await asyncio.sleep(n * self.ramp / total)
+
+		while time.monotonic() < deadline:
+
+			# pick the options in turns
+			opts = self.mix[n % len(self.mix)]
+			n += total
+
+			session = LoadSession(self.address, self.port, opts, self.phases, pool)
+			started = time.monotonic()
+
+			try:
+				success = await session.run()
+			except Exception as e:
+				success = False
+				session.error_msg = repr(e)
+
+			session.close()
+			session.error = not success
+			session.endSession(time.monotonic() - started)
+			self.challenges += session.challenges
+
+			if success:
+				self.completed += 1
+			else:
+				self.failed += 1
+				self.errors[session.error_msg] = self.errors.get(session.error_msg, 0) + 1
+
+		return
+
+	def results(self):
+		'''
+		Returns the results as a dict.
+		'''
+		elapsed = self.elapsed or 1.0
+
+		return {
+			'sessions': self.sessions,
+			'duration': self.duration,
+			'ramp': self.ramp,
+			'options': self.mix,
+			'workers': self.workers,
+			'reuse': self.reuse,
+			'elapsed': self.elapsed,
+			'completed': self.completed,
+			'failed': self.failed,
+			'challenges': self.challenges,
+			'sessions_per_s': self.completed / elapsed,
+			'challenges_per_s': self.challenges / elapsed,
+			'tcp_opened': self.tcp_opened,
+			'tcp_reused': self.tcp_reused,
+			'errors': self.errors,
+			'phases': {phase: hist.summary() for phase, hist in self.phases.items()},
+		}
+
+	def report(self):
+		'''
+		Print the results.
+		'''
+		res = self.results()
+
+		self.ui.beginBlock()
+		self.ui.info("Results ({:.1f} s)".format(res['elapsed']))
+		self.ui.text("Sessions:___{} ok, {} failed, {:.1f}/s".format(res['completed'], res['failed'], res['sessions_per_s']), leftPad=7)
+		self.ui.text("Challenges:_{}, {:.1f}/s".format(res['challenges'], res['challenges_per_s']), leftPad=7)
+
+		if res['reuse']:
+			self.ui.text("TCP:________{} connections opened, reused {} times".format(res['tcp_opened'], res['tcp_reused']), leftPad=7)
+		self.ui.emptyLine()
+
+		# latencies in milliseconds
+		self.ui.text("{:<12}{:>8}{:>9}{:>9}{:>9}{:>9}{:>9}".format('phase (ms)', 'count', 'mean', 'p50', 'p90', 'p99', 'max'), leftPad=7, wrap=False, noSpace=True, bold=True)
+		for phase, s in res['phases'].items():
+			self.ui.text("{:<12}{:>8}{:>9.2f}{:>9.2f}{:>9.2f}{:>9.2f}{:>9.2f}".format(
+				phase, s['count'], 1000*s['mean'], 1000*s['p50'], 1000*s['p90'], 1000*s['p99'], 1000*s['max']
+			), leftPad=7, wrap=False, noSpace=True)
+
+		if res['errors']:
+			self.ui.emptyLine()
+			for msg, count in res['errors'].items():
+				self.ui.warning("{} x {}".format(count, msg.strip()))
+
+		self.ui.emptyLine()
+		self.ui.endBlock()
+		return
+
+	def validateArgs(self, args):
+		'''
+		Usage: <address> <port> [--sessions=N] [--duration=S] [--ramp=S]
+		[--options=emp,n,...] [--workers=N] [--reuse] [--metrics=FILE]
+		[--metrics-interval=S] [--ansi=0]
+		'''
+		positional, flags = parse_flags(args)
+		self.filename = positional[0]
+
+		try:
+			self.address = str(positional[1])
+			self.port = int(positional[2])
+
+			self.sessions = int(flags.get('sessions', self.sessions))
+			self.duration = float(flags.get('duration', self.duration))
+			self.ramp = float(flags.get('ramp', self.ramp))
+
+			self.workers = int(flags.get('workers', self.workers))
+			self.reuse = 'reuse' in flags
+
+			self.metrics_path = str(flags.get('metrics', ''))
+			self.metrics_interval = float(flags.get('metrics-interval', 0))
+
+			if 'options' in flags:
+				self.mix = str(flags['options']).split(',')
+
+			ansi = int(flags.get('ansi', 1)) != 0
+
+			if self.sessions < 1 or self.duration < 0 or self.ramp < 0 or self.workers < 0:
+				raise ValueError()
+
+			# one worker per core
+			if self.workers == 0:
+				self.workers = os.cpu_count() or 1
+
+		except Exception:
+			return self.setError("Invalid arguments!\n_______\tusage: {} <server address> <server port> [--sessions=N] [--duration=S] [--ramp=S] [--options=emp,n,...] [--workers=N] [--reuse] [--metrics=FILE] [--metrics-interval=S] [--ansi=0]".format(self.filename))
+
+		if ansi:
+			self.ui.enableANSI()
+
+		return True
+
+	def writeMetrics(self):
+		'''
+		Write the metrics of all the sessions (see Metrics.py).
+		'''
+		if not self.metrics_path: return
+
+		metrics.stopExport()
+
+		try:
+			metrics.write(self.metrics_path)
+		except OSError as e:
+			return self.setError("Can't write the metrics: {}".format(e))
+
+		self.ui.info_ok("Metrics written to {}".format(self.metrics_path))
+		return True
+
+	def setError(self, msg):
+		'''
+		Sets an error, see Client.setError().
+		'''
+		self.error_msg = self.ui.error(msg, noPrint=True)
+		self.error = True
+
+		return False
+
+
+def run_shard(shard):
+	'''
+	Runs one shard of the load in a worker process. Returns the
+	LoadGenerator with its results (it gets pickled to the parent).
+	'''
+	address, port, sessions, duration, ramp, mix, reuse, first, total = shard
+
+	loadgen = LoadGenerator()
+	loadgen.address = address
+	loadgen.port = port
+	loadgen.sessions = sessions
+	loadgen.duration = duration
+	loadgen.ramp = ramp
+	loadgen.mix = mix
+	loadgen.reuse = reuse
+	loadgen.first = first
+	loadgen.total = total
+
+	asyncio.run(loadgen.run())
+	loadgen.metrics = metrics
+
+	return loadgen
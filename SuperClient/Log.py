@@ -2,18 +2,93 @@
 	This class takes care of saving/printing detailed
 	information of what's happening during execution.
 '''
+
+from SuperClient.Trace import EVENTS
+
 class Log:
 	ui = None
 	verbose = False
+	tracer = None 		# Tracer for the events (optional)
+	session = '' 		# session id in the trace records
+
+	MODES = {} 			# (class, verbose, traced, UI events) --> class with the user methods bound
+
+	def __new__(cls, ui, verbose, tracer=None):
+		'''
+		The user methods are called on the hot paths: the instance is
+		created from a class where they only do what's needed (or nothing),
+		see mode().
+		'''
+		return super().__new__(cls.mode(verbose, tracer is not None, ui.LOG_EVENTS))
 
-	def __init__(self, ui, verbose):
+	def __init__(self, ui, verbose, tracer=None):
 		self.verbose = verbose
 		self.ui = ui
+		self.tracer = tracer
+		self.session = ''
 
 		if not self.verbose: return
 
 		self.ui.text("Verbose mode active.")
 
+	@classmethod
+	def mode(cls, verbose, traced, ui_events=()):
+		'''
+		Returns a subclass where each user method prints (if @verbose), records
+		a trace record (if @traced), does both or nothing. The methods are
+		replaced in the class rather than in the instance so that calling them
+		is as fast as calling any method.
+
+		The events in @ui_events are also passed to UI.logEvent(), for UIs
+		that show them in their own way.
+		'''
+		cls = getattr(cls, 'base', cls)
+		key = (cls, verbose, traced, ui_events)
+
+		if key not in Log.MODES:
+			methods = {
+				event[0]: cls.bind(
+					getattr(cls, event[0]) if verbose else None,
+					event_id if traced else None,
+					event[0] if event[0] in ui_events else None
+				)
+				for event_id, event in enumerate(EVENTS)
+			}
+			methods['base'] = cls
+			Log.MODES[key] = type(cls.__name__, (cls,), methods)
+
+		return Log.MODES[key]
+
+	@staticmethod
+	def bind(printer, event_id, ui_event=None):
+		'''
+		Returns a user method that calls @printer (a user method) and/or
+		records the event @event_id and/or passes the event @ui_event to
+		the UI.
+		'''
+		if ui_event is not None:
+			def show(self, *args):
+				if event_id is not None: self.tracer.record(event_id, self.session, args)
+				self.ui.logEvent(ui_event, args)
+				if printer: printer(self, *args)
+
+			return show
+
+		if event_id is None:
+			return printer or Log.ignore
+
+		def trace(self, *args):
+			self.tracer.record(event_id, self.session, args)
+
+		def trace_print(self, *args):
+			self.tracer.record(event_id, self.session, args)
+			printer(self, *args)
+
+		return trace_print if printer else trace
+
+	def ignore(self, *args):
+		pass
+
 	def warning(self, text):
 		if not self.verbose: return
 
@@ -34,39 +109,55 @@ class Log:
 	#--------------------------------------------------
 	# User methods that have one purpose only: to be
 	# used in a certain situation, it's up to the user.
+	# They are only called when verbose, see mode().
 	# -------------------------------------------------
 	
 	def received_tcp(self, messages):
-		if not self.verbose: return
-
 		self.debug('TCP message received: ')
 		for m in messages:
 			self.ui.text("%r" % m, wrap=False, leftPad=8, linePrefix='        ')
 
 	def received_udp(self, message):
-		if not self.verbose: return
-
 		self.debug('UDP message received: ')
 		self.ui.text("%r" % message, wrap=False, leftPad=8, linePrefix='        ')
 
 	def sent(self, ack, remaining, length, msg, protocol):
-		if not self.verbose: return
-
 		self.debug(protocol + ' message sent: ')
 		self.ui.text("ACK: {}, remaining: {}, len: {}, content: {}".format(ack, remaining, length, msg), wrap=False, leftPad=8, linePrefix='        ')
 
 
+	def parity_errors(self, offsets, length):
+		self.warning("Parity check failed at {} of {} characters: {}".format(len(offsets), length, offsets))
+
+	def duplicate_fragment(self, remain, length):
+		self.warning("Duplicate fragment dropped (remaining: {}, len: {}).".format(remain, length))
+
+	def malformed_datagram(self, size):
+		self.warning("Malformed datagram dropped ({} bytes).".format(size))
+
+	def non_ascii(self, count):
+		self.warning("{} non-ASCII bytes can't have a parity bit, sent as '?' instead.".format(count))
+
+	def keystream_lost(self):
+		self.warning("The decrypted message is not text: the encryption keys are out of step.")
+
+	def keys_resynced(self, skipped):
+		self.warning("The encryption keys were out of step: {} keys skipped.".format(skipped))
+
+	def timeout(self, retry, timeout):
+		self.warning("No response. Asking again (retry {}, next timeout {:.2f} s).".format(retry, timeout))
+
 	def invalid_msg(self):
-		if not self.verbose: return
-		
 		self.ui.text('Invalid message. Asking for retransmission.\n')
 
 	def no_encryption_keys(self):
-		if not self.verbose: return
-
 		self.warning("No encryption keys. Sending as plain text.")
 
 	def no_decryption_keys(self):
-		if not self.verbose: return
-
 		self.warning("No decryption keys. Received as plain text.")
+
+	def rekeyed(self, count):
+		self.debug("Rekeyed: {} new keys for encryption and decryption.".format(count))
+
+	def rekey_failed(self):
+		self.warning("Rekeying failed. The keys will run out.")
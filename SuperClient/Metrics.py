@@ -0,0 +1,305 @@
+'''
+	SuperClient/Metrics.py
+	This file contains classes for collecting measurements, e.g. latencies.
+	Histograms use logarithmic buckets (like HDR histograms) so that they
+	have the same relative precision from microseconds to minutes, take
+	very little memory and can be merged together.
+
+	The registry (MetricsRegistry) holds the named counters and histograms
+	of a process and exports them as Prometheus text or JSON.
+'''
+
+import json
+import math
+import os
+import threading
+import time
+
+HIST_PRECISION = 0.01 					# relative width of a bucket (1 %)
+HIST_MIN_VALUE = 1e-6 					# smaller values go to the first bucket
+METRICS_PREFIX = 'superclient_' 		# prefix of the exported metric names
+EXPORT_QUANTILES = [50, 90, 99] 		# percentiles of the exported histograms
+
+
+class Histogram:
+	'''
+	Histogram of non-negative values (seconds, bytes...). A value v goes to
+	the bucket floor(log(v / min) / log(1 + precision)), so each bucket is
+	@precision wider than the previous one. Only non-empty buckets are stored.
+	'''
+	buckets = {} 		# bucket index --> count
+	count = 0
+	total = 0.0
+	min = None
+	max = None
+	precision = HIST_PRECISION
+	log_base = 0.0
+
+	def __init__(self, precision=HIST_PRECISION):
+		self.buckets = {}
+		self.count = 0
+		self.total = 0.0
+		self.min = None
+		self.max = None
+		self.precision = precision
+		self.log_base = math.log(1 + precision)
+
+	def record(self, value):
+		'''
+		Add a value to the histogram.
+		'''
+		index = self.bucketOf(value)
+		self.buckets[index] = self.buckets.get(index, 0) + 1
+
+		self.count += 1
+		self.total += value
+
+		if self.min is None or value < self.min: self.min = value
+		if self.max is None or value > self.max: self.max = value
+
+		return
+
+	def merge(self, other):
+		'''
+		Add all the values of another histogram (with the same precision)
+		to this one.
+		'''
+		if other.precision != self.precision:
+			raise ValueError("Can't merge histograms with different precisions")
+
+		for index, count in other.buckets.items():
+			self.buckets[index] = self.buckets.get(index, 0) + count
+
+		self.count += other.count
+		self.total += other.total
+
+		if other.min is not None and (self.min is None or other.min < self.min): self.min = other.min
+		if other.max is not None and (self.max is None or other.max > self.max): self.max = other.max
+
+		return
+
+	def percentile(self, p):
+		'''
+		Returns the value below which @p percent of the values are.
+		The value is accurate within the precision of the histogram.
+		'''
+		if self.count == 0: return 0.0
+
+		rank = max(1, math.ceil(self.count * p / 100))
+		seen = 0
+
+		for index in sorted(self.buckets):
+			seen += self.buckets[index]
+			if seen >= rank:
+				# upper edge of the bucket, but never beyond the real extremes
+				return min(max(self.valueOf(index + 1), self.min), self.max)
+
+		return self.max
+
+	def mean(self):
+		'''
+		Average of the values.
+		'''
+		return self.total / self.count if self.count else 0.0
+
+	def summary(self):
+		'''
+		Returns the most interesting numbers as a dict.
+		'''
+		return {
+			'count': self.count,
+			'mean': self.mean(),
+			'min': self.min or 0.0,
+			'p50': self.percentile(50),
+			'p90': self.percentile(90),
+			'p99': self.percentile(99),
+			'max': self.max or 0.0,
+		}
+
+	def bucketOf(self, value):
+		'''
+		Index of the bucket that @value belongs to.
+		'''
+		if value <= HIST_MIN_VALUE: return 0
+		return int(math.log(value / HIST_MIN_VALUE) / self.log_base)
+
+	def valueOf(self, index):
+		'''
+		Lower edge of the bucket @index.
+		'''
+		return HIST_MIN_VALUE * (1 + self.precision) ** index
+
+
+class Counter:
+	'''
+	A number that only goes up (datagrams sent, retransmissions...).
+	'''
+	value = 0
+
+	def __init__(self):
+		self.value = 0
+
+	def inc(self, n=1):
+		self.value += n
+
+
+class MetricsRegistry:
+	'''
+	Named counters and histograms. The connection classes and the client get
+	their metrics from here once (e.g. when created) and update them directly,
+	so updating costs a method call, not a lookup by name.
+
+	The metrics can be written to a file at exit (write()) or every now and
+	then by a background thread (exportEvery()). The file is JSON if its name
+	ends with '.json', otherwise Prometheus text format.
+	'''
+	counters = {} 		# name --> Counter
+	histograms = {} 	# name --> Histogram
+	help = {} 			# name --> description
+	lock = None
+	thread = None 		# periodic export
+	stopping = None
+
+	def __init__(self):
+		self.counters = {}
+		self.histograms = {}
+		self.help = {}
+		self.lock = threading.Lock()
+		self.thread = None
+		self.stopping = threading.Event()
+
+	def __getstate__(self):
+		'''
+		Only the metrics are pickled (e.g. from a worker process), not the lock.
+		'''
+		return {'counters': self.counters, 'histograms': self.histograms, 'help': self.help}
+
+	def __setstate__(self, state):
+		self.__init__()
+		self.__dict__.update(state)
+
+	def counter(self, name, help=''):
+		'''
+		Returns the counter @name, creates it if needed.
+		'''
+		with self.lock:
+			if name not in self.counters:
+				self.counters[name] = Counter()
+				self.help[name] = help
+
+			return self.counters[name]
+
+	def histogram(self, name, help=''):
+		'''
+		Returns the histogram @name, creates it if needed.
+		'''
+		with self.lock:
+			if name not in self.histograms:
+				self.histograms[name] = Histogram()
+				self.help[name] = help
+
+			return self.histograms[name]
+
+	def merge(self, other):
+		'''
+		Add the metrics of another registry (e.g. of a worker process).
+		'''
+		for name, counter in other.counters.items():
+			self.counter(name, other.help.get(name, '')).inc(counter.value)
+
+		for name, hist in other.histograms.items():
+			self.histogram(name, other.help.get(name, '')).merge(hist)
+
+		return
+
+	def snapshot(self):
+		'''
+		Returns the current values as a dict.
+		'''
+		return {
+			'time': time.time(),
+			'counters': {name: counter.value for name, counter in sorted(self.counters.items())},
+			'histograms': {name: hist.summary() for name, hist in sorted(self.histograms.items())},
+		}
+
+	def prometheus(self):
+		'''
+		Returns the current values in Prometheus text format. Counters get
+		the suffix _total, histograms are exported as summaries.
+		'''
+		lines = []
+
+		for name, counter in sorted(self.counters.items()):
+			full = METRICS_PREFIX + name + '_total'
+			lines += self.header(full, self.help.get(name), 'counter')
+			lines.append('{} {}'.format(full, counter.value))
+
+		for name, hist in sorted(self.histograms.items()):
+			full = METRICS_PREFIX + name
+			lines += self.header(full, self.help.get(name), 'summary')
+
+			for q in EXPORT_QUANTILES:
+				lines.append('{}{{quantile="{}"}} {!r}'.format(full, q / 100, hist.percentile(q)))
+
+			lines.append('{}_sum {!r}'.format(full, hist.total))
+			lines.append('{}_count {}'.format(full, hist.count))
+
+		return '\n'.join(lines) + '\n'
+
+	@staticmethod
+	def header(name, help, kind):
+		'''
+		The HELP and TYPE lines of a metric.
+		'''
+		lines = ['# HELP {} {}'.format(name, help)] if help else []
+		return lines + ['# TYPE {} {}'.format(name, kind)]
+
+	def write(self, path):
+		'''
+		Write the current values to @path. The file is replaced
+		at once, so a reader never sees half of it.
+		'''
+		if path.endswith('.json'):
+			data = json.dumps(self.snapshot(), indent=2)
+		else:
+			data = self.prometheus()
+
+		with open(path + '.tmp', 'w') as file:
+			file.write(data)
+
+		os.replace(path + '.tmp', path)
+		return
+
+	def exportEvery(self, path, interval):
+		'''
+		Write the values to @path every @interval seconds in the background
+		until stopExport() is called.
+		'''
+		def exporter():
+			while not self.stopping.wait(interval):
+				try:
+					self.write(path)
+				except OSError:
+					pass
+
+		self.stopping.clear()
+		self.thread = threading.Thread(target=exporter, daemon=True)
+		self.thread.start()
+
+		return
+
+	def stopExport(self):
+		'''
+		Stop the periodic export.
+		'''
+		if self.thread is None: return
+
+		self.stopping.set()
+		self.thread.join()
+		self.thread = None
+
+		return
+
+
+# shared by all the clients and connections of a process
+metrics = MetricsRegistry()
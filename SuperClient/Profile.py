@@ -0,0 +1,165 @@
+'''
+	SuperClient/Profile.py
+	Profiling of real sessions: the CPU time per function (cProfile) and the
+	memory allocated per line (tracemalloc). Snapshots are taken at the
+	phases of a session (see Client.profilePhase()) and reports are written
+	to a directory at the end:
+
+		profile.pstats 		the whole profile, for pstats, snakeviz etc.
+		NN-<phase>.pstats 	the profile up to each phase
+		cpu.txt 			the hot functions, by own and cumulative time
+		memory.txt 			the top allocations at each phase and what changed
+'''
+
+import cProfile
+import io
+import os
+import pstats
+import tracemalloc
+
+PROFILE_TOP = 30 						# functions/lines listed in the reports
+PROFILE_FRAMES = 1 						# traceback depth of the memory allocations
+
+
+class Profiler:
+	'''
+	Profiles whatever runs between start() and stop(). Both profilers are
+	optional since tracemalloc in particular slows everything down a lot.
+	'''
+	directory = ''
+	cpu = True
+	memory = True
+	top = PROFILE_TOP
+	profile = None 		# cProfile.Profile
+	phases = [] 		# (name, tracemalloc snapshot or None)
+	running = False
+	tracing = False 	# did start() start tracemalloc (and stop() stops it)
+
+	def __init__(self, directory, cpu=True, memory=True, top=PROFILE_TOP):
+		self.directory = directory
+		self.cpu = cpu
+		self.memory = memory
+		self.top = top
+		self.profile = None
+		self.phases = []
+		self.running = False
+		self.tracing = False
+
+	def start(self):
+		'''
+		Create the directory for the reports and start profiling.
+		Raises OSError if the directory can't be created.
+		'''
+		os.makedirs(self.directory, exist_ok=True)
+
+		# tracing started by someone else is left running at the end
+		if self.memory and not tracemalloc.is_tracing():
+			tracemalloc.start(PROFILE_FRAMES)
+			self.tracing = True
+
+		if self.cpu:
+			self.profile = cProfile.Profile()
+			self.profile.enable()
+
+		self.running = True
+		return
+
+	def phase(self, name):
+		'''
+		Take snapshots at the end of a phase of the session.
+		'''
+		if not self.running: return
+
+		number = len(self.phases) + 1
+
+		# the snapshots themselves are not profiled
+		if self.cpu:
+			self.profile.disable()
+			self.profile.dump_stats(self.path('{:02}-{}.pstats'.format(number, name)))
+
+		snapshot = tracemalloc.take_snapshot() if self.memory else None
+		self.phases.append((name, snapshot))
+
+		if self.cpu:
+			self.profile.enable()
+
+		return
+
+	def stop(self):
+		'''
+		Stop profiling (taking the last snapshot) and write the reports.
+		'''
+		if not self.running: return
+
+		self.phase('end')
+		self.running = False
+
+		if self.cpu:
+			self.profile.disable()
+			self.profile.dump_stats(self.path('profile.pstats'))
+			self.writeCPU()
+
+		if self.tracing:
+			tracemalloc.stop()
+			self.tracing = False
+
+		if self.memory:
+			self.writeMemory()
+
+		return
+
+	def writeCPU(self):
+		'''
+		Write the hot functions sorted by their own time and by the
+		cumulative time (including the functions they call).
+		'''
+		out = io.StringIO()
+		stats = pstats.Stats(self.profile, stream=out)
+		stats.strip_dirs()
+
+		for key, title in (('tottime', 'own time'), ('cumulative', 'cumulative time')):
+			out.write("Top {} functions by {}\n".format(self.top, title))
+			stats.sort_stats(key).print_stats(self.top)
+
+		with open(self.path('cpu.txt'), 'w') as file:
+			file.write(out.getvalue())
+
+		return
+
+	def writeMemory(self):
+		'''
+		Write the lines that had allocated the most memory at each phase
+		and how that changed since the previous phase.
+		'''
+		lines = []
+		previous = None
+
+		for name, snapshot in self.phases:
+			# leave out the profilers themselves
+			snapshot = snapshot.filter_traces([
+				tracemalloc.Filter(False, tracemalloc.__file__),
+				tracemalloc.Filter(False, cProfile.__file__),
+				tracemalloc.Filter(False, __file__),
+				tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+			])
+
+			total = sum(stat.size for stat in snapshot.statistics('filename'))
+			lines.append("=== {}: {:.1f} KiB allocated".format(name, total / 1024))
+
+			lines.append("Top {} lines:".format(self.top))
+			lines += [str(stat) for stat in snapshot.statistics('lineno')[:self.top]]
+
+			if previous is not None:
+				lines.append("Changes since the previous phase:")
+				lines += [str(stat) for stat in snapshot.compare_to(previous, 'lineno')[:self.top]]
+
+			lines.append('')
+			previous = snapshot
+
+		with open(self.path('memory.txt'), 'w') as file:
+			file.write('\n'.join(lines))
+
+		return
+
+	def path(self, filename):
+		return os.path.join(self.directory, filename)
@@ -0,0 +1,590 @@
+'''
+	SuperClient/Server.py
+	A reference server implementing the coursework protocol (see
+	doc/assignment/coursework_2020.pdf), so the client can be tested and
+	benchmarked without the real thing. It runs on asyncio and handles any
+	number of sessions at the same time.
+
+	The protocol in short:
+	TCP:  client --> "HELLO [ENC] [MUL] [PAR] [SYNC]" (+ keys + "." if ENC)
+	      server --> "HELLO <cid> <udp port> [SYNC]" (+ keys + "." if ENC)
+	UDP:  client --> "HELLO from <cid>"
+	      server --> challenge (words), client --> the words in reverse order
+	      ...repeated a few times...
+	      server --> last message with EOM set (not encrypted, no parity)
+	Either side may answer "Send again" (ACK not set) to have the last message
+	sent again, encrypted with new keys. SYNC is an extension of the protocol
+	(see UDPConnection.enableKeySync()): "Send again" is not encrypted and the
+	message is sent again exactly as it was, so that both sides keep using the
+	keys in step when datagrams are lost.
+
+	To measure how the client copes with a bad network, the server can drop,
+	delay and reorder datagrams and break their parity bits on purpose.
+'''
+
+import asyncio
+from random import Random
+import threading
+import time
+
+from SuperClient.Communication import *
+from SuperClient.Log import Log
+from SuperClient.UI import UI
+from SuperClient.utils import parse_flags
+
+CID_CHARS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+KEY_CHARS = '0123456789abcdef'
+KEY_LEN = 64 							# characters in an encryption key
+SESSION_TIMEOUT = 60.0 					# idle sessions are forgotten after this (s)
+CHALLENGE_WORDS = (
+	'the quick brown fox jumps over lazy dog internet packet socket client '
+	'server parity bit key cipher stream datagram fragment router gateway '
+	'latency jitter bandwidth protocol header checksum wappu sima beer'
+).split(' ')
+
+
+class ServerSession(UDPConnection):
+	'''
+	The server's end of a UDP session. Uses the protocol methods of
+	UDPConnection, the socket is shared and owned by ReferenceServer.
+	'''
+	state = 'hello' 		# hello --> challenge --> done
+	addr = None 			# client's address, updated on every datagram
+	challenge = '' 			# latest challenge sent
+	last = '' 				# latest message sent (for retransmissions)
+	answered = 0 			# challenges answered
+	correct = 0 			# ...correctly
+	last_seen = 0.0
+	rx_hold = False 		# messages are handled as they arrive, there's no one to wait
+
+	def createSocket(self):
+		return None
+
+	def createPool(self):
+		return None
+
+	def close(self):
+		return
+
+
+class ServerProtocol(asyncio.DatagramProtocol):
+	'''
+	Passes received datagrams to the server.
+	'''
+	server = None
+
+	def __init__(self, server):
+		self.server = server
+
+	def connection_made(self, transport):
+		self.server.udp_transport = transport
+
+	def datagram_received(self, data, addr):
+		self.server.handleDatagram(data, addr)
+
+
+class ReferenceServer:
+	# where to listen, port 0 = pick a free port
+	address = '127.0.0.1'
+	tcp_port = 0
+	udp_port = 0
+
+	# protocol settings
+	challenges = 5 			# challenges per session
+	max_words = 30 			# words per challenge
+	keyset_len = 20
+
+	# fault injection (probabilities 0...1 and seconds)
+	loss = 0.0 				# datagram is dropped
+	reorder = 0.0 			# datagram is sent after the next one
+	corrupt = 0.0 			# a parity bit of the datagram is flipped
+	delay = 0.0 			# every datagram is delayed this much...
+	jitter = 0.0 			# ...plus a random amount up to this
+	seed = None
+
+	sessions = {} 			# cid --> ServerSession
+	stats = {}
+	rand = None
+
+	tcp_server = None
+	udp_transport = None
+	loop = None
+	thread = None
+
+	# error handling
+	error = False
+	error_msg = ''
+
+	verbose = False
+	ui = None
+	log = None
+
+	def __init__(self, ui=None, verbose=False):
+		self.error = False
+		self.ui = ui if ui is not None else UI(False)
+		self.verbose = verbose
+		self.log = Log(self.ui, verbose)
+		self.sessions = {}
+		self.stats = {
+			'sessions': 0, 			# TCP HELLOs handled
+			'completed': 0, 		# sessions that reached EOM
+			'correct': 0, 			# correct solutions
+			'wrong': 0, 			# wrong solutions
+			'retransmissions': 0, 	# "Send again"s received
+			'rekeys': 0, 			# REKEYs handled
+			'datagrams': 0, 		# datagrams sent
+			'dropped': 0,
+			'dropped_first': 0, 	# first fragments of multipart messages dropped
+			'reordered': 0,
+			'corrupted': 0,
+		}
+
+	def run(self, args):
+		'''
+		Validate the arguments and serve until interrupted (Ctrl+C).
+		'''
+		if not self.validateArgs(args):
+			return
+
+		try:
+			asyncio.run(self.serve())
+		except KeyboardInterrupt:
+			pass
+
+		self.report()
+
+	async def start(self):
+		'''
+		Start listening on TCP and UDP. The actual ports are
+		available in @self.tcp_port and @self.udp_port after this.
+		'''
+		self.rand = Random(self.seed)
+		self.loop = asyncio.get_running_loop()
+
+		self.tcp_server = await asyncio.start_server(self.handleTCP, self.address, self.tcp_port)
+		self.tcp_port = self.tcp_server.sockets[0].getsockname()[1]
+
+		await self.loop.create_datagram_endpoint(lambda: ServerProtocol(self), local_addr=(self.address, self.udp_port))
+		self.udp_port = self.udp_transport.get_extra_info('sockname')[1]
+
+		return
+
+	async def serve(self):
+		'''
+		Start the server and keep serving until cancelled.
+		'''
+		await self.start()
+
+		self.ui.info("Listening on {}, TCP port {}, UDP port {}".format(self.address, self.tcp_port, self.udp_port))
+
+		try:
+			while True:
+				await asyncio.sleep(SESSION_TIMEOUT / 4)
+				self.forgetIdle()
+		finally:
+			self.close()
+
+	def close(self):
+		'''
+		Stop listening.
+		'''
+		if self.tcp_server is not None: self.tcp_server.close()
+		if self.udp_transport is not None: self.udp_transport.close()
+
+		return
+
+	def startInThread(self):
+		'''
+		Run the server in a background thread (with its own event loop),
+		e.g. to test the blocking Client in the same process. Returns
+		once the server is listening.
+		'''
+		ready = threading.Event()
+
+		def run():
+			loop = asyncio.new_event_loop()
+			asyncio.set_event_loop(loop)
+			loop.run_until_complete(self.start())
+			ready.set()
+			loop.run_forever()
+			self.close()
+
+			# e.g. handlers of connections kept open by clients
+			tasks = asyncio.all_tasks(loop)
+			for task in tasks:
+				task.cancel()
+
+			loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+			loop.close()
+
+		self.thread = threading.Thread(target=run, daemon=True)
+		self.thread.start()
+		ready.wait()
+
+		return
+
+	def stopThread(self):
+		'''
+		Stop a server started with startInThread().
+		'''
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.thread.join()
+
+		return
+
+
+	#--------------------------------------------------
+	# 					  TCP
+	#--------------------------------------------------
+
+	async def handleTCP(self, reader, writer):
+		'''
+		Handles a TCP connection. Any number of HELLOs can be
+		sent over the same connection.
+		'''
+		stream = LineReader(MSG_DELIMETER, ENCODING)
+		request = None 		# first line of a request waiting for its keys
+		keys = []
+
+		while True:
+			try:
+				data = await reader.read(RECV_BYTES)
+			except (asyncio.CancelledError, ConnectionError):
+				# server stopped or client went away
+				break
+
+			if not data: break
+
+			stream.feed(data)
+			lines = list(stream.messages())
+
+			# the client doesn't end its request with a delimiter,
+			# so the last line is complete if it ends the request
+			tail = stream.tail()
+			if tail == MSG_END or (request is None and tail.startswith('HELLO')):
+				lines.append(stream.flush())
+
+			for line in lines:
+				if request is None:
+					if not line: continue
+
+					request = line.split(' ')
+					keys = []
+
+					if request[0] not in ('HELLO', 'REKEY'):
+						writer.close()
+						return
+
+					# wait for the keys
+					if request[0] == 'REKEY' or 'ENC' in request: continue
+
+				elif line != MSG_END:
+					keys.append(line)
+					continue
+
+				if request[0] == 'HELLO':
+					response = self.hello(request[1:], keys)
+				else:
+					response = self.rekey(request[1] if len(request) > 1 else '', keys)
+
+				writer.write(response.encode(ENCODING))
+				request = None
+
+			await writer.drain()
+
+		writer.close()
+		return
+
+	def hello(self, opts, client_keys):
+		'''
+		Create a new session. Returns the response to the HELLO.
+		'''
+		cid = ''.join(self.rand.choice(CID_CHARS) for i in range(8))
+		while cid in self.sessions:
+			cid = ''.join(self.rand.choice(CID_CHARS) for i in range(8))
+
+		session = ServerSession(cid, None, 0, self.log)
+		session.last_seen = time.monotonic()
+		session.beginReceive()
+		response = ['HELLO {} {}'.format(cid, self.udp_port)]
+
+		if 'ENC' in opts:
+			keys = self.newKeys()
+			session.enableEncryption(keys, client_keys)
+			response += keys + ['.']
+
+			if 'SYNC' in opts:
+				session.enableKeySync()
+				response[0] += ' SYNC'
+
+		if 'MUL' in opts: session.enableMultipart()
+		if 'PAR' in opts: session.enableParityCheck()
+
+		self.sessions[cid] = session
+		self.stats['sessions'] += 1
+
+		return MSG_DELIMETER.join(response) + MSG_DELIMETER
+
+
+	def rekey(self, cid, client_keys):
+		'''
+		Add new keys to a session (an extension of the protocol, see
+		Client.checkKeys()). Returns the response with the server's new keys.
+		'''
+		session = self.sessions.get(cid)
+
+		if session is None or not session.opt_enc or len(client_keys) != self.keyset_len:
+			return 'ERROR' + MSG_DELIMETER
+
+		keys = self.newKeys()
+		session.enc_keys_de.extend(client_keys)
+		session.enc_keys_en.extend(keys)
+		self.stats['rekeys'] += 1
+
+		return MSG_DELIMETER.join(['REKEY ' + cid] + keys + [MSG_END]) + MSG_DELIMETER
+
+	def newKeys(self):
+		'''
+		A new keyset for a session.
+		'''
+		return [''.join(self.rand.choice(KEY_CHARS) for i in range(KEY_LEN)) for k in range(self.keyset_len)]
+
+
+	#--------------------------------------------------
+	# 					  UDP
+	#--------------------------------------------------
+
+	def handleDatagram(self, packet, addr):
+		'''
+		Pass a datagram to its session and respond once
+		a whole message has been received.
+		'''
+		cid = packet[:8].decode(ENCODING, 'replace')
+		session = self.sessions.get(cid)
+
+		if session is None or len(packet) != session.frames.size:
+			return
+
+		session.addr = addr
+		session.last_seen = time.monotonic()
+
+		try:
+			status = session.handleDatagram(packet)
+		except RetransmissionError:
+			# the client keeps sending garbage, give up
+			del self.sessions[cid]
+			return
+
+		if status == session.RX_RETRY:
+			self.transmit(session, MSG_RETRANSMIT, ack=False)
+
+		elif status == session.RX_RESEND:
+			self.stats['retransmissions'] += 1
+
+			if session.opt_sync:
+				self.deliver(session, session.tx_last, eom=(session.state == 'done'))
+			else:
+				self.transmit(session, session.last, eom=(session.state == 'done'))
+
+			session.beginReceive()
+
+		elif status == session.RX_DONE:
+			self.respond(session, session.rx_message.decode(ENCODING, 'replace'))
+
+			# the retries are counted per message
+			session.beginReceive()
+
+		return
+
+	def respond(self, session, message):
+		'''
+		Respond to a complete message from the client.
+		'''
+		if session.state == 'hello':
+			session.state = 'challenge'
+
+		elif session.state == 'challenge':
+			session.answered += 1
+
+			if message == ' '.join(session.challenge.split(' ')[::-1]):
+				session.correct += 1
+				self.stats['correct'] += 1
+			else:
+				self.stats['wrong'] += 1
+
+		else:
+			# session is over, nothing to say
+			return
+
+		# enough challenges --> end of messaging
+		if session.answered >= self.challenges:
+			session.state = 'done'
+			self.stats['completed'] += 1
+			self.transmit(session, "You answered {} of {} challenges correctly. Bye!".format(session.correct, self.challenges), eom=True)
+			return
+
+		session.challenge = self.newChallenge(session)
+		self.transmit(session, session.challenge)
+
+		return
+
+	def newChallenge(self, session):
+		'''
+		A random sequence of words. Without multipart, it must fit in one datagram.
+		'''
+		words = [self.rand.choice(CHALLENGE_WORDS) for i in range(self.rand.randint(1, self.max_words))]
+
+		if not session.opt_mul:
+			while len(' '.join(words)) > session.mul_len and len(words) > 1:
+				words.pop()
+
+		return ' '.join(words)
+
+	def transmit(self, session, message, eom=False, ack=True):
+		'''
+		Send a message to the client of a session, with faults if configured.
+		The last message is not encrypted and has no parity. Messages with
+		@ack are kept to be sent again (see UDPConnection.resend()).
+		'''
+		data = message.encode(ENCODING)
+
+		if eom:
+			datagrams = [bytes(session.pack(session.cid, True, True, 0, len(data), data))]
+		else:
+			datagrams = [bytes(datagram) for datagram in session.datagrams(data, ack)]
+
+		if ack:
+			session.last = message
+			session.tx_last = datagrams
+
+		self.deliver(session, datagrams, eom)
+		return
+
+	def deliver(self, session, datagrams, eom=False):
+		'''
+		Send the datagrams of a message, with faults if configured.
+		The faults are applied to a copy of @datagrams.
+		'''
+		datagrams = list(datagrams)
+
+		# without encryption, losing this one goes unnoticed (see ReassemblyBuffer)
+		first = datagrams[0] if len(datagrams) > 1 else None
+
+		# break parity bits
+		if session.opt_par and not eom and self.corrupt:
+			datagrams = [self.corruptDatagram(session, d) if self.rand.random() < self.corrupt else d for d in datagrams]
+
+		# swap datagrams with the next one
+		if self.reorder:
+			for k in range(len(datagrams) - 1):
+				if self.rand.random() < self.reorder:
+					datagrams[k], datagrams[k + 1] = datagrams[k + 1], datagrams[k]
+					self.stats['reordered'] += 1
+
+		for datagram in datagrams:
+
+			if self.rand.random() < self.loss:
+				self.stats['dropped'] += 1
+				if datagram is first: self.stats['dropped_first'] += 1
+				continue
+
+			self.stats['datagrams'] += 1
+
+			if self.delay or self.jitter:
+				self.loop.call_later(self.delay + self.jitter * self.rand.random(), self.udp_transport.sendto, datagram, session.addr)
+			else:
+				self.udp_transport.sendto(datagram, session.addr)
+
+		return
+
+	def corruptDatagram(self, session, datagram):
+		'''
+		Flip the lowest bit of one content byte so that the parity check fails.
+		'''
+		header = len(datagram) - CONTENT_BYTES
+		length = session.frames.header.unpack_from(datagram)[-1]
+
+		if not length: return datagram
+
+		corrupted = bytearray(datagram)
+		corrupted[header + self.rand.randrange(length)] ^= 1
+		self.stats['corrupted'] += 1
+
+		return bytes(corrupted)
+
+	def forgetIdle(self):
+		'''
+		Forget sessions that haven't been heard of in a while.
+		'''
+		now = time.monotonic()
+
+		for cid in [cid for cid, s in self.sessions.items() if now - s.last_seen > SESSION_TIMEOUT]:
+			del self.sessions[cid]
+
+		return
+
+	def report(self):
+		'''
+		Print the statistics.
+		'''
+		self.ui.beginBlock()
+		self.ui.info("Statistics")
+		for name, value in self.stats.items():
+			self.ui.text("{:<16}{:>8}".format(name, value), leftPad=7, wrap=False, noSpace=True)
+
+		self.ui.emptyLine()
+		self.ui.endBlock()
+		return
+
+	def validateArgs(self, args):
+		'''
+		Usage: [--address=A] [--port=N] [--udp-port=N] [--challenges=N]
+		[--loss=P] [--reorder=P] [--corrupt=P] [--delay=S] [--jitter=S]
+		[--seed=N] [--verbose] [--ansi=0]
+		'''
+		positional, flags = parse_flags(args)
+		filename = positional[0]
+
+		try:
+			self.address = str(flags.get('address', self.address))
+			self.tcp_port = int(flags.get('port', self.tcp_port))
+			self.udp_port = int(flags.get('udp-port', self.udp_port))
+			self.challenges = int(flags.get('challenges', self.challenges))
+
+			self.loss = float(flags.get('loss', self.loss))
+			self.reorder = float(flags.get('reorder', self.reorder))
+			self.corrupt = float(flags.get('corrupt', self.corrupt))
+			self.delay = float(flags.get('delay', self.delay))
+			self.jitter = float(flags.get('jitter', self.jitter))
+
+			if 'seed' in flags:
+				self.seed = int(flags['seed'])
+
+			ansi = int(flags.get('ansi', 1)) != 0
+
+			if self.challenges < 1 or self.delay < 0 or self.jitter < 0:
+				raise ValueError()
+
+			for p in (self.loss, self.reorder, self.corrupt):
+				if not 0 <= p <= 1: raise ValueError()
+
+		except Exception:
+			return self.setError("Invalid arguments!\n_______\tusage: {} [--address=A] [--port=N] [--udp-port=N] [--challenges=N] [--loss=P] [--reorder=P] [--corrupt=P] [--delay=S] [--jitter=S] [--seed=N] [--verbose] [--ansi=0]".format(filename))
+
+		if 'verbose' in flags:
+			self.verbose = True
+			self.log = Log(self.ui, True)
+
+		if ansi:
+			self.ui.enableANSI()
+
+		return True
+
+	def setError(self, msg):
+		'''
+		Sets an error, see Client.setError().
+		'''
+		self.error_msg = self.ui.error(msg, noPrint=True)
+		self.error = True
+
+		return False
@@ -0,0 +1,179 @@
+'''
+	SuperClient/Trace.py
+	Structured tracing of protocol events (datagrams sent and received,
+	timeouts, parity errors...). Recording an event only appends a small
+	tuple to an in-memory ring buffer, a background thread turns them into
+	records and writes them to a file, either as JSON lines or as fixed-size
+	binary records.
+
+	Log decides which events are traced: events that are neither printed nor
+	traced are bound to a function that does nothing (see Log.mode()).
+'''
+
+import json
+import struct
+import threading
+import time
+from collections import deque
+
+TRACE_CAPACITY = 65536 					# records kept in memory, the oldest are dropped
+TRACE_FLUSH_INTERVAL = 0.5 				# write the records at least this often (s)
+TRACE_FLUSH_AT = 4096 					# ...or when this many are waiting
+RECORD_FORMAT = '!dH8sII' 				# binary record: time, event, session, a, b
+
+# traced events (Log's user methods), the index is the event id in binary traces:
+# (name, name of field a, name of field b, arguments of the event --> (a, b))
+EVENTS = [
+	('sent', 'length', 'remain', lambda ack, remaining, length, msg, protocol: (length, remaining)),
+	('received_udp', 'length', '', lambda message: (len(message), 0)),
+	('received_tcp', 'messages', '', lambda messages: (len(messages), 0)),
+	('parity_errors', 'errors', 'length', lambda offsets, length: (len(offsets), length)),
+	('duplicate_fragment', 'length', 'remain', lambda remain, length: (length, remain)),
+	('timeout', 'retry', 'timeout_ms', lambda retry, timeout: (retry, int(1000 * timeout))),
+	('invalid_msg', '', '', lambda: (0, 0)),
+	('no_encryption_keys', '', '', lambda: (0, 0)),
+	('no_decryption_keys', '', '', lambda: (0, 0)),
+	('rekeyed', 'keys', '', lambda count: (count, 0)),
+	('rekey_failed', '', '', lambda: (0, 0)),
+	('malformed_datagram', 'bytes', '', lambda size: (size, 0)),
+	('keystream_lost', '', '', lambda: (0, 0)),
+	('keys_resynced', 'skipped', '', lambda skipped: (skipped, 0)),
+	('non_ascii', 'bytes', '', lambda count: (count, 0)),
+]
+EVENT_IDS = {event[0]: k for k, event in enumerate(EVENTS)}
+
+
+class Tracer:
+	'''
+	Collects trace records and writes them to @path in the background. The
+	file is binary if its name ends with '.bin', otherwise JSON lines.
+
+	A record is (time, event id, session, a, b), where a and b are
+	event-specific numbers (sizes, counts), see EVENTS. The ring buffer keeps
+	the arguments of the events as they are, the numbers are picked from
+	them by the writer thread. If the writer can't keep up, the oldest
+	records are dropped (and counted in @dropped).
+	'''
+	path = ''
+	binary = False
+	file = None
+	records = None 		# the ring buffer
+	dropped = 0
+	written = 0
+	packer = None 		# binary record struct
+	wakeup = None 		# tells the writer thread to write now
+	thread = None
+	closed = False
+
+	def __init__(self, path, capacity=TRACE_CAPACITY):
+		self.path = path
+		self.binary = path.endswith('.bin')
+		self.file = open(path, 'wb' if self.binary else 'w')
+		self.records = deque(maxlen=capacity)
+		self.dropped = 0
+		self.written = 0
+		self.packer = struct.Struct(RECORD_FORMAT)
+		self.wakeup = threading.Event()
+		self.closed = False
+
+		self.thread = threading.Thread(target=self.writer, daemon=True)
+		self.thread.start()
+
+	def record(self, event, session, args):
+		'''
+		Add a record. @event is an event id (see EVENT_IDS) and @args
+		the arguments of the event.
+		'''
+		records = self.records
+		count = len(records)
+
+		# waking up the writer takes a lock, so only once per batch
+		if count >= TRACE_FLUSH_AT:
+			if count == TRACE_FLUSH_AT: self.wakeup.set()
+			elif count == records.maxlen: self.dropped += 1
+
+		records.append((time.time(), event, session, args))
+
+	def close(self):
+		'''
+		Write the remaining records and close the file.
+		'''
+		if self.closed: return
+
+		self.closed = True
+		self.wakeup.set()
+		self.thread.join()
+		self.file.close()
+
+		return
+
+	def writer(self):
+		'''
+		The writer thread: writes the records every now and then.
+		'''
+		while not self.closed:
+			self.wakeup.wait(TRACE_FLUSH_INTERVAL)
+			self.wakeup.clear()
+			self.flush()
+
+		# records added just before closing
+		self.flush()
+
+	def flush(self):
+		'''
+		Write the records in the buffer to the file.
+		'''
+		batch = []
+		records = self.records
+
+		while records:
+			t, event, session, args = records.popleft()
+			batch.append((t, event, session) + EVENTS[event][3](*args))
+
+		if not batch: return
+
+		if self.binary:
+			self.file.write(b''.join(
+				self.packer.pack(t, event, session.encode('utf-8'), a, b) for t, event, session, a, b in batch
+			))
+		else:
+			self.file.write(''.join(json.dumps(self.toDict(record)) + '\n' for record in batch))
+
+		self.file.flush()
+		self.written += len(batch)
+
+		return
+
+	@staticmethod
+	def toDict(record):
+		'''
+		A record as a dict with the event and field names.
+		'''
+		t, event, session, a, b = record
+		name, field_a, field_b, sizes = EVENTS[event]
+
+		data = {'t': t, 'event': name, 'session': session}
+		if field_a: data[field_a] = a
+		if field_b: data[field_b] = b
+
+		return data
+
+	@staticmethod
+	def read(path):
+		'''
+		Generator that yields the records of a trace file (binary or
+		JSON lines) as dicts.
+		'''
+		if not path.endswith('.bin'):
+			with open(path) as file:
+				for line in file:
+					yield json.loads(line)
+			return
+
+		packer = struct.Struct(RECORD_FORMAT)
+
+		with open(path, 'rb') as file:
+			data = file.read()
+
+		for t, event, session, a, b in packer.iter_unpack(data):
+			yield Tracer.toDict((t, event, session.rstrip(b'\0').decode('utf-8', 'replace'), a, b))
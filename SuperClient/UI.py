@@ -2,8 +2,37 @@
 UI.py
 	This file contains all of the "UI" components. The UI actually consists of
 	characters printed on console. And some imagination.
+
+	Rendered text is collected into a buffer and written with one write per
+	line, per block of lines (see UI.beginBlock()) or when enough text has
+	piled up, instead of a print() for each piece.
+
+	Besides the UI for humans there are backends for automation: one that
+	writes the events of a session as JSON lines and one that writes nothing
+	(see UI_BACKENDS).
+
+	The writes can also be done by a background thread (see AsyncSink), so
+	that a slow terminal or a full pipe doesn't stall the session.
 '''
 
+import functools
+import json
+import sys
+import threading
+import time
+from collections import deque
+
+from SuperClient.Metrics import metrics
+
+UI_FLUSH_SIZE = 16384 					# write a block when this many characters are buffered
+UI_FLUSH_INTERVAL = 0.1 				# ...or when it has been buffered this long (s)
+UI_CACHE_SIZE = 512 					# rendered texts kept (see UI.render())
+SINK_CAPACITY = 1024 					# writes waiting for the writer thread
+SINK_COALESCE_MAX = 65536 				# coalesced writes are at most this long (characters)
+SINK_POLICIES = ('drop', 'coalesce', 'block') 	# what to do when the queue is full
+SINK_BLOCK_WAIT = 0.5 					# a blocked write checks this often that the writer thread is alive (s)
+UI_COLORS = ('purple', 'blue', 'green', 'yellow', 'red', 'grey')
+
 # ANSI formatting
 class txt:
 	purple = '\033[95m' 		# purple
@@ -59,16 +88,71 @@ class UI:
 	ELEM_HLINE_END = '+'
 	ELEM_VLINE =     '|'
 
+	# Log events that this UI shows as its own events (see Log.mode())
+	LOG_EVENTS = ()
+
 	txt = None
+	styles = {} 		# (clr, bold, ul) --> (ANSI prefix, suffix)
+	vline = '' 			# the vertical border, styled
+
+	# output
+	stream = None 		# where to write, sys.stdout if None
+	sink = None 		# AsyncSink that does the writing, if enabled
+	buffer = [] 		# rendered text waiting to be written
+	buffered = 0 		# ...and its length
+	blocks = 0 			# depth of nested blocks
+	flushed_at = 0.0
 
 	def __init__(self, ansi):
 		self.ansi = ansi
 		self.txt = txt(ansi)
+		self.buffer = []
+		self.buffered = 0
+		self.blocks = 0
+		self.buildStyles()
 		return
 
 	def enableANSI(self):
 		self.ansi = True
 		self.txt = txt(True)
+		self.buildStyles()
+
+	def enableAsync(self, policy='drop', capacity=SINK_CAPACITY):
+		'''
+		Write in a background thread from now on, see AsyncSink.
+		'''
+		self.flush()
+		self.sink = AsyncSink(self.stream or sys.stdout, policy, capacity)
+
+	def close(self):
+		'''
+		Write the rest of the output and stop the background thread (if
+		any). Further output is written directly.
+		'''
+		self.flush()
+
+		if self.sink is not None:
+			self.sink.close()
+			self.sink = None
+
+		return
+
+	def buildStyles(self):
+		'''
+		Precompute the ANSI codes around text of each style. Equivalent to
+		wrapping the text in bold, then underline, then color.
+		'''
+		t = self.txt
+		self.styles = {}
+
+		for clr in ('',) + UI_COLORS:
+			for bold in (False, True):
+				for ul in (False, True):
+					prefix = (getattr(t, clr) if clr else '') + (t.underline if ul else '') + (t.bold if bold else '')
+					self.styles[(clr, bold, ul)] = (prefix, t.endc * (bool(clr) + ul + bold))
+
+		self.vline = f"{t.bold}{self.ELEM_VLINE}{t.endc}"
+		return
 	
 
 	#--------------------------------------------------
@@ -152,6 +236,36 @@ class UI:
 		self.text(f"    {bullet} ", newLine=False, leftPad=7, wrap=False)
 		self.text(text, clr='grey', linePrefix="       \t      ")
 
+	def challenge(self, challenge, solution, eom):
+		'''
+		Show a challenge from the server and the solution to it. The last
+		message (@eom) has no solution, it's just shown.
+		'''
+		if eom:
+			self.text(f" Server: \"{challenge}\"\n", leftPad=7, wrap=False)
+			self.resetNumbering()
+			return
+
+		self.beginBlock()
+		self.numbered("Challenge accepted:")
+		self.indented("»", f"\"{challenge}\"")
+		self.indented("«", f"\"{solution}\"\n",)
+		self.endBlock()
+
+	def event(self, name, **fields):
+		'''
+		A machine-readable event (the handshake, an error...). Humans see
+		these from the other methods, so they are ignored here.
+		'''
+		return
+
+	def logEvent(self, name, args):
+		'''
+		A Log event listed in @self.LOG_EVENTS, @args are the arguments of
+		the Log method.
+		'''
+		return
+
 
 	#--------------------------------------------------
 	# 			    PRIMITIVE UI METHODS
@@ -177,99 +291,77 @@ class UI:
 		This also prevents word wrap.
 		'''
 
-		fw = self.frame_width
-		
-		if noPrint:
-			line_buffer = ''
-
 		if leftPad == -1:
 			if self.mode_border:
 				leftPad = 2 		# default padding for border mode
 			else:
 				leftPad = 0
 
+		# decoration and color (unknown colors are ignored)
+		style = self.styles.get((clr, bold, ul))
+		if style is None:
+			style = self.styles[('', bool(bold), bool(ul))]
+		prefix, suffix = style
+
+		rendered = self.render(
+			text, self.frame_width, self.vline if self.mode_border else '', prefix, suffix,
+			center, wrap, leftPad, linePrefix, noSpace, '\n' if newLine and not noPrint else ''
+		)
 
+		# Aaand... Action!
+		if noPrint:
+			# TODO: add newlines
+			return rendered
+
+		self.write(rendered)
+		return
+
+	@staticmethod
+	@functools.lru_cache(maxsize=UI_CACHE_SIZE)
+	def render(text, fw, vline, prefix, suffix, center, wrap, leftPad, linePrefix, noSpace, end):
+		'''
+		Renders a text (see @self.text()) into a string, @end after each line.
+		The vertical borders are @vline, none if it's empty.
+
+		The same texts (the logo, the description, prompts...) are rendered
+		again and again, so the most recent ones are cached, for the whole
+		process. The arguments are the key, so everything that affects
+		the result must be one of them.
+		'''
 		# first of all, split the text in lines if necessary
 		if wrap:
-			lines, line_lens = self.wrapText(text)
+			lines, line_lens = UI.wrapLines(text, fw)
 		else:
 			lines, line_lens = [text], [len(text)]
 
+		rendered = []
+
 		for lnum,line in enumerate(lines):
 			# underscore --> space
 			if not noSpace:
 				if '_' in line:
 					line = line.replace('_', ' ')
-			line_len = line_lens[lnum]
-
-
-			# Text Decoration
-
-			if bold:
-				line = f"{self.txt.bold}{line}{self.txt.endc}"
-			if ul:
-				line = f"{self.txt.underline}{line}{self.txt.endc}"
-
 
-			# Colors
-
-			# luckily python has switch-case...
-			# COLORS, tho! I'm drunk, send help.
-			if clr:
-				if clr == 'purple':
-					line = f"{self.txt.purple}{line}{self.txt.endc}"
-				elif clr == 'blue':
-					line = f"{self.txt.blue}{line}{self.txt.endc}"
-				elif clr == 'green':
-					line = f"{self.txt.green}{line}{self.txt.endc}"
-				elif clr == 'yellow':
-					line = f"{self.txt.yellow}{line}{self.txt.endc}"
-				elif clr == 'red':
-					line = f"{self.txt.red}{line}{self.txt.endc}"
-				elif clr == 'grey':
-					line = f"{self.txt.grey}{line}{self.txt.endc}"
-
-
-			# Padding
+			# Padding and vertical borders
 
 			# frame mode is required to center a line (pad = padding)
-			if self.mode_border:
-				pad = fw - line_len - 2 		# -2 because of borders in both ends
+			if vline:
+				pad = fw - line_lens[lnum] - 2 		# -2 because of borders in both ends
 
 				# if centered: use integer division
 				# if default (left padding), just padding of 2 (or user defined)
-				leftPad = pad // 2 if center else leftPad
-				rightPad = pad - leftPad
-					
-				# print(leftPad, line_len, rightPad)
-				line = ''.join([' ' * leftPad]) + line + ''.join([' ' * rightPad])
+				left = pad // 2 if center else leftPad
+				line = f"{vline}{' ' * left}{prefix}{line}{suffix}{' ' * (pad - left)}{vline}"
 			else:
-				line = ''.join([' ' * leftPad]) + line
-
-			# Vertical Borders
-
-			if self.mode_border:
-				# bolded borders
-				line = f"{self.txt.bold}{self.ELEM_VLINE}{self.txt.endc}{line}{self.txt.bold}{self.ELEM_VLINE}{self.txt.endc}"
+				line = f"{' ' * leftPad}{prefix}{line}{suffix}"
 
 			# add a line prefix if there's one
 			if lnum > 0:
 				line = linePrefix + line
-			
 
-			# Aaand... Action!
-			if noPrint:
-				# TODO: add newlines
-				line_buffer += line
-			else:
-				if newLine:
-					print(line)
-				else:
-					print(line, end='')
+			rendered.append(line)
 
-		if noPrint:
-			return line_buffer
-		return
+		return end.join(rendered) + end
 
 	def borderStart(self):
 		'''
@@ -287,6 +379,27 @@ class UI:
 		self.mode_border = False
 		return
 
+	def beginBlock(self):
+		'''
+		Start a block of lines that are written to the console at once
+		(or in a few writes if it gets long). Blocks can be nested.
+		'''
+		if self.blocks == 0:
+			self.flushed_at = time.monotonic()
+
+		self.blocks += 1
+		return
+
+	def endBlock(self):
+		'''
+		Ends a block and writes it. See @self.beginBlock()
+		'''
+		self.blocks -= 1
+
+		if self.blocks == 0:
+			self.flush()
+		return
+
 	def resetNumbering(self):
 		'''
 		'''
@@ -323,6 +436,47 @@ class UI:
 		self.text()
 
 
+	#--------------------------------------------------
+	# 					 OUTPUT
+	#--------------------------------------------------
+
+	def write(self, text):
+		'''
+		Buffer rendered text. Outside of blocks it's written when a line
+		is complete, in blocks when the block ends or the buffer gets full
+		or old.
+		'''
+		self.buffer.append(text)
+		self.buffered += len(text)
+
+		if self.blocks == 0:
+			if text.endswith('\n'):
+				self.flush()
+		elif self.buffered >= UI_FLUSH_SIZE or time.monotonic() - self.flushed_at >= UI_FLUSH_INTERVAL:
+			self.flush()
+
+		return
+
+	def flush(self):
+		'''
+		Write the buffered text (to stdout by default) with one write, or
+		pass it to the sink.
+		'''
+		if not self.buffer: return
+
+		buffer, self.buffer = self.buffer, []
+		self.buffered = 0
+
+		if self.sink is not None:
+			self.sink.write(''.join(buffer))
+		else:
+			(self.stream or sys.stdout).write(''.join(buffer))
+
+		self.flushed_at = time.monotonic()
+
+		return
+
+
 	#--------------------------------------------------
 	# 				 UTILITY METHODS
 	#--------------------------------------------------
@@ -333,38 +487,242 @@ class UI:
 		'''
 		Divides a long line of text into multiple lines by spaces.
 		Similar to __partition() method in UDPConnection class!
-
-		NOTE: This is not by any meanas the most efficient way but it works!
 		'''
+		return self.wrapLines(text, self.frame_width)
 
-		# first, split the test into individual words
-		words = text.split(' ')
+	@staticmethod
+	def wrapLines(text, fw):
+		'''
+		Wraps @text to lines that fit in a frame of width @fw.
+		Returns the lines and their lengths.
 
-		lines = ['']
-		lengths = [0]
-		curr_line = 0
+		The words of a line are collected to a list and joined once the
+		line is full, so this takes linear time.
+		'''
+		lines = []
+		lengths = []
+		words = [] 				# of the current line
+		length = 0
+		limit = fw - 4
 
-		for word in words:
+		for word in text.split(' '):
 			word_len = len(word)+1
 
 			# first word of first line, this is annoying...
-			if curr_line == 0 and lengths[0] == 0:
+			if not lines and length == 0:
 				word_len -= 1
 
 			# overflow --> new line
-			if lengths[curr_line] + word_len >= (self.frame_width - 4):
-				curr_line += 1
-				lines.append('')
-				lengths.append(0)
+			if length + word_len >= limit:
+				lines.append(' '.join(words))
+				lengths.append(length)
+				words = []
+				length = 0
 				word_len -= 1
 
-			# add word to the line
-			if len(lines[curr_line]) == 0:
-				lines[curr_line] += word
-			else:
-				lines[curr_line] += ' ' + word
+			# add word to the line (empty words at the start don't add spaces)
+			if words or word:
+				words.append(word)
 
 			# update the length
-			lengths[curr_line] += word_len
+			length += word_len
+
+		lines.append(' '.join(words))
+		lengths.append(length)
 
 		return (lines, lengths)
+
+
+class SilentUI(UI):
+	'''
+	A UI that doesn't print anything. Texts requested with noPrint
+	(e.g. error messages) are still formatted and returned.
+	Used when running lots of sessions at once.
+	'''
+
+	def text(self, *args, noPrint=False, **kwargs):
+		if noPrint:
+			return super().text(*args, noPrint=True, **kwargs)
+		return
+
+	def challenge(self, challenge, solution, eom):
+		return
+
+
+class JsonLinesUI(SilentUI):
+	'''
+	A UI for automation: instead of the texts, writes one compact JSON
+	object per event, e.g.
+
+		{"t":1589123456.78,"event":"challenge","n":1,"text":"..."}
+
+	The events are handshake, challenge, solution, retransmit, eom and
+	error. ANSI is never enabled so that the error messages are plain too.
+	'''
+	LOG_EVENTS = ('timeout', 'invalid_msg')
+
+	challenges = 0 		# of the current session
+
+	def enableANSI(self):
+		return
+
+	def challenge(self, challenge, solution, eom):
+		if eom:
+			self.event('eom', text=challenge)
+			self.challenges = 0
+			return
+
+		self.challenges += 1
+		self.event('challenge', n=self.challenges, text=challenge)
+		self.event('solution', n=self.challenges, text=solution)
+
+	def event(self, name, **fields):
+		self.write(json.dumps(dict({'t': time.time(), 'event': name}, **fields), separators=(',', ':')) + '\n')
+
+	def logEvent(self, name, args):
+		# both ask the server to send the message again
+		if name == 'timeout':
+			retry, timeout = args
+			self.event('retransmit', reason='timeout', retry=retry, timeout=round(timeout, 3))
+		else:
+			self.event('retransmit', reason='invalid')
+
+
+class AsyncSink:
+	'''
+	Writes text to @stream in a background thread. The writes wait in a
+	queue of @capacity writes, and the thread writes everything that is
+	waiting with one write. If the stream can't keep up and the queue fills
+	up, @policy decides what happens to a new write:
+
+		drop 		it's dropped (and counted in @dropped)
+		coalesce 	it's appended to the last write in the queue, unless
+					that's SINK_COALESCE_MAX long already (then dropped)
+		block 		the caller waits for room, like a direct write would (if the
+					thread has died, the queue is written directly instead)
+	'''
+	stream = None
+	policy = 'drop'
+	capacity = SINK_CAPACITY
+	queue = None 		# writes waiting for the thread
+	ready = None 		# threading.Condition, guards the queue
+	dropped = 0
+	coalesced = 0
+	thread = None
+	closed = False
+
+	# metrics
+	m_dropped = metrics.counter('ui_writes_dropped', "Console writes dropped because the queue was full")
+	m_coalesced = metrics.counter('ui_writes_coalesced', "Console writes coalesced because the queue was full")
+
+	def __init__(self, stream, policy='drop', capacity=SINK_CAPACITY):
+		if policy not in SINK_POLICIES or capacity < 1:
+			raise ValueError("Invalid overflow policy or capacity: {}, {}".format(policy, capacity))
+
+		self.stream = stream
+		self.policy = policy
+		self.capacity = capacity
+		self.queue = deque()
+		self.ready = threading.Condition()
+		self.dropped = 0
+		self.coalesced = 0
+		self.closed = False
+
+		self.thread = threading.Thread(target=self.writer, daemon=True)
+		self.thread.start()
+
+	def write(self, text):
+		'''
+		Queue @text to be written.
+		'''
+		with self.ready:
+			queue = self.queue
+
+			if len(queue) >= self.capacity:
+				if self.policy == 'block':
+					while len(queue) >= self.capacity and self.thread.is_alive():
+						self.ready.wait(SINK_BLOCK_WAIT)
+
+					# no one is going to make room
+					if len(queue) >= self.capacity:
+						queue.append(text)
+						self.writeQueued()
+						return
+
+				elif self.policy == 'coalesce' and len(queue[-1]) < SINK_COALESCE_MAX:
+					queue[-1] += text
+					self.coalesced += 1
+					self.m_coalesced.inc()
+					return
+
+				else:
+					self.dropped += 1
+					self.m_dropped.inc()
+					return
+
+			queue.append(text)
+			self.ready.notify_all()
+
+		return
+
+	def writeQueued(self):
+		'''
+		Write everything in the queue in the calling thread, when the writer
+		thread is gone. Call with @ready held.
+		'''
+		text = ''.join(self.queue)
+		self.queue.clear()
+
+		try:
+			self.stream.write(text)
+			self.stream.flush()
+		except (OSError, ValueError):
+			self.dropped += 1
+			self.m_dropped.inc()
+
+		return
+
+	def close(self):
+		'''
+		Write what's in the queue and stop the thread.
+		'''
+		with self.ready:
+			self.closed = True
+			self.ready.notify_all()
+
+		self.thread.join()
+		return
+
+	def writer(self):
+		'''
+		The writer thread: takes everything in the queue and writes it.
+		'''
+		while True:
+			with self.ready:
+				while not self.queue and not self.closed:
+					self.ready.wait()
+
+				if not self.queue: return
+
+				text = ''.join(self.queue)
+				self.queue.clear()
+
+				# there's room for the blocked writes
+				self.ready.notify_all()
+
+			try:
+				self.stream.write(text)
+				self.stream.flush()
+			except (OSError, ValueError):
+				# the stream is broken or closed, the text is lost
+				with self.ready:
+					self.dropped += 1
+					self.m_dropped.inc()
+
+
+# the UIs that can be chosen with --ui=NAME
+UI_BACKENDS = {
+	'human': UI,
+	'jsonl': JsonLinesUI,
+	'silent': SilentUI,
+}
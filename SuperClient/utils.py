@@ -1,8 +1,28 @@
+import os
+
+
 def random_bytes(n):
 	'''
-	Return n random bytes using urandom file in Linux.
-	For this, I found some help from stackoverflow.
+	Return n random bytes from the operating system's CSPRNG.
+	Works on every platform, unlike reading /dev/urandom.
+	'''
+	return os.urandom(n)
+
+
+def parse_flags(args):
+	'''
+	Separate '--name=value' flags from the positional arguments.
+	Returns a tuple containing a list of positional arguments and
+	a dict of flags. A flag without a value is set to True.
 	'''
+	positional, flags = [], {}
+
+	for arg in args:
+		if not arg.startswith('--'):
+			positional.append(arg)
+			continue
+
+		name, sep, value = arg[2:].partition('=')
+		flags[name] = value if sep else True
 
-	with open('/dev/urandom', 'rb') as file:
-	 	return file.read(n)
+	return (positional, flags)
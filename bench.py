@@ -0,0 +1,12 @@
+import sys
+from SuperClient.Benchmark import Benchmark
+
+if __name__ == '__main__':
+
+	# run the benchmarks and write the results
+	bench = Benchmark()
+	bench.start(sys.argv)
+
+	# invalid arguments or regressions
+	if bench.error:
+		sys.exit(bench.error_msg)
@@ -0,0 +1,12 @@
+import sys
+from SuperClient.LoadGen import LoadGenerator
+
+if __name__ == '__main__':
+
+	# run the load with given arguments and print a report
+	loadgen = LoadGenerator()
+	loadgen.start(sys.argv)
+
+	# if arguments were invalid, show the message
+	if loadgen.error:
+		sys.exit(loadgen.error_msg)
@@ -0,0 +1,12 @@
+import sys
+from SuperClient.Server import ReferenceServer
+
+if __name__ == '__main__':
+
+	# serve until interrupted, then print statistics
+	server = ReferenceServer()
+	server.run(sys.argv)
+
+	# if arguments were invalid, show the message
+	if server.error:
+		sys.exit(server.error_msg)
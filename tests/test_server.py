@@ -0,0 +1,179 @@
+'''
+	tests/test_server.py
+	Whole sessions against the reference server: over a lossy network and
+	with a server that doesn't do rekeying.
+	Run with: python3 -m unittest discover tests
+'''
+
+import asyncio
+import time
+import unittest
+
+import SuperClient.Client
+from SuperClient.AsyncClient import AsyncClient
+from SuperClient.Client import Client
+from SuperClient.Server import ReferenceServer
+from SuperClient.UI import SilentUI
+
+SESSIONS = 5 							# sessions per option set
+CHALLENGES = 20 						# challenges per session
+LOSS = 0.1 								# probability that the server drops a datagram
+TIMEOUT = 0.2 							# client's initial UDP timeout (s)
+REKEY_TIMEOUT = 0.5 					# client's wait for new keys (s)
+
+
+class LossTest(unittest.TestCase):
+	'''
+	The server drops its datagrams at random. Every lost datagram is asked
+	again. With encryption the client asks for the SYNC extension, so both
+	ends keep using the keys in step: a single key out of step would make
+	every later answer wrong. Multipart messages use up the keys quickly,
+	so those sessions fetch new ones (--rekey) to stay encrypted.
+	The first fragment of a multipart message can be lost without anyone
+	noticing (the rest looks like a shorter message, and with encryption a
+	few characters may decrypt to text by chance), so those answers may be
+	wrong, but only that many of them.
+	'''
+	server = None
+
+	def setUp(self):
+		self.server = ReferenceServer(SilentUI(False))
+		self.server.seed = 1
+		self.server.loss = LOSS
+		self.server.challenges = CHALLENGES
+		self.server.startInThread()
+
+	def tearDown(self):
+		self.server.stopThread()
+
+	def runSessions(self, opts, *flags):
+		for i in range(SESSIONS):
+			client = Client()
+			client.ui = SilentUI(False)
+			client.udp_timeout = TIMEOUT
+			client.start(['test', '127.0.0.1', str(self.server.tcp_port), opts, '0'] + list(flags))
+
+			self.assertFalse(client.error, client.error_msg)
+
+		stats = self.server.stats
+		self.assertGreater(stats['dropped'], 0)
+		self.assertGreater(stats['retransmissions'], 0)
+		self.assertEqual(stats['completed'], SESSIONS)
+		self.assertEqual(stats['correct'] + stats['wrong'], SESSIONS * CHALLENGES)
+		if 'm' in opts:
+			self.assertLessEqual(stats['wrong'], stats['dropped_first'])
+		else:
+			self.assertEqual(stats['wrong'], 0)
+
+	def test_plain(self):
+		self.runSessions('n')
+
+	def test_encryption(self):
+		self.runSessions('e', '--keysync')
+
+	def test_parity(self):
+		self.runSessions('p')
+
+	def test_encryption_parity(self):
+		self.runSessions('ep', '--keysync')
+
+	def test_multipart(self):
+		self.runSessions('m')
+
+	def test_multipart_parity(self):
+		self.runSessions('mp')
+
+	def test_encryption_multipart(self):
+		self.runSessions('em', '--keysync', '--rekey')
+
+	def test_encryption_multipart_parity(self):
+		self.runSessions('emp', '--keysync', '--rekey')
+
+
+class KeystreamTest(unittest.TestCase):
+	'''
+	Without the SYNC extension, a lost datagram puts the keys out of step.
+	The client must notice that the messages no longer decrypt to text and
+	stop with an error instead of answering garbage. A short message may
+	decrypt to text by chance, but not two in a row.
+	'''
+	server = None
+
+	def setUp(self):
+		self.server = ReferenceServer(SilentUI(False))
+		self.server.seed = 1
+		self.server.loss = 0.3
+		self.server.challenges = CHALLENGES
+		self.server.startInThread()
+
+	def tearDown(self):
+		self.server.stopThread()
+
+	def test_keys_out_of_step(self):
+		failed = 0
+		for i in range(SESSIONS):
+			client = Client()
+			client.ui = SilentUI(False)
+			client.udp_timeout = TIMEOUT
+			client.start(['test', '127.0.0.1', str(self.server.tcp_port), 'e', '0'])
+			if client.error: failed += 1
+
+		self.assertGreater(failed, 0)
+		self.assertLessEqual(self.server.stats['wrong'], failed)
+
+
+class SilentServer(ReferenceServer):
+	'''
+	Keeps the TCP connection open but never answers a REKEY.
+	'''
+	def rekey(self, cid, client_keys):
+		return ''
+
+
+class RekeyTest(unittest.TestCase):
+	'''
+	A session that outlives its keys waits for new ones only once, then
+	goes on without rekeying.
+	'''
+	server = None
+	timeout = 0.0
+
+	def setUp(self):
+		self.timeout = SuperClient.Client.REKEY_TIMEOUT
+		SuperClient.Client.REKEY_TIMEOUT = REKEY_TIMEOUT
+
+		self.server = SilentServer(SilentUI(False))
+		self.server.challenges = 3 * Client.keyset_len
+		self.server.startInThread()
+
+	def tearDown(self):
+		self.server.stopThread()
+		SuperClient.Client.REKEY_TIMEOUT = self.timeout
+
+	def test_no_answer(self):
+		client = Client()
+		client.ui = SilentUI(False)
+
+		started = time.monotonic()
+		client.start(['test', '127.0.0.1', str(self.server.tcp_port), 'e', '0', '--rekey'])
+
+		self.assertFalse(client.error, client.error_msg)
+		self.assertTrue(client.rekey_stopped)
+		self.assertLess(time.monotonic() - started, 2 * REKEY_TIMEOUT)
+		self.assertEqual(self.server.stats['wrong'], 0)
+
+	def test_no_answer_async(self):
+		client = AsyncClient()
+		client.ui = SilentUI(False)
+
+		started = time.monotonic()
+		asyncio.run(client.start(['test', '127.0.0.1', str(self.server.tcp_port), 'e', '0', '--rekey']))
+
+		self.assertFalse(client.error, client.error_msg)
+		self.assertTrue(client.rekey_stopped)
+		self.assertLess(time.monotonic() - started, 2 * REKEY_TIMEOUT)
+		self.assertEqual(self.server.stats['wrong'], 0)
+
+
+if __name__ == '__main__':
+	unittest.main()